@@ -0,0 +1,56 @@
+import random
+import time
+import tracemalloc
+import v4
+from mc import EventCounter
+from v4_obj import AlarmEventSelection, HeapAlarmEventSelection
+
+
+'''wraps the strategy selection and satisfaction phases, summing the memory
+each call allocates on top of what was live when it started (tracemalloc
+peak minus starting size), i.e. the statements, copies and sets it builds'''
+def trace_strategy(strategy, totals):
+    def traced(name):
+        f = getattr(strategy, name)
+
+        def wrapper(*args):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            result = f(*args)
+            totals[name] = totals.get(name, 0) + tracemalloc.get_traced_memory()[1] - base
+            return result
+        setattr(strategy, name, wrapper)
+    for name in ['selectable_events', 'is_satisfied']:
+        traced(name)
+
+
+def measure(strategy_cls, factory, seed=0, trace=True):
+    random.seed(seed)
+    counter = EventCounter()
+    prog = factory(listener=counter, seed=seed)
+    prog.event_selection_strategy = strategy_cls(max_time=factory.max_time)
+    totals = {}
+    if trace:
+        trace_strategy(prog.event_selection_strategy, totals)
+        tracemalloc.start()
+    start = time.perf_counter()
+    prog.run()
+    wall = time.perf_counter() - start
+    if trace:
+        tracemalloc.stop()
+    events = max(counter.events, 1)
+    return {'events': counter.events, 'wall': wall,
+            'selection_per_event': totals.get('selectable_events', 0) / events,
+            'satisfaction_per_event': totals.get('is_satisfied', 0) / events}
+
+
+if __name__ == '__main__':
+    for n_lines in [2, 10, 40]:
+        factory = v4.grid_factory(n_lines, 3, max_time=500, in_oper_f_r=0.02)
+        for cls in [AlarmEventSelection, HeapAlarmEventSelection]:
+            r = measure(cls, factory)
+            wall = measure(cls, factory, trace=False)['wall']
+            print(f'{n_lines:3d} lines {cls.__name__:24s} {r["events"]:5d} events '
+                  f'{wall:7.2f}s  allocated per event: '
+                  f'selection {r["selection_per_event"] / 1024:8.1f} KiB  '
+                  f'satisfaction {r["satisfaction_per_event"] / 1024:8.1f} KiB')
@@ -0,0 +1,143 @@
+import sys
+import time
+import numpy as np
+import bppy as bp
+from v4_obj import AlarmEventSelection, ContextualBProgram, GridState, HeapAlarmEventSelection, \
+    E, TEvent, sync
+
+# churn scenario: faults every exponential(1) hours, each dispatching a repair
+# crew bthread that works exponential(work) hours and ends; some crews are
+# cancelled (removed) and some put on hold (suspended until the next fault)
+work = 10.0
+cancel_every = 10
+hold_every = 7
+
+
+@bp.thread
+def crew(k, stream):
+    yield sync(request=E('dispatch', data={'k': k}))
+    yield sync(request=TEvent(stream.exponential(work), 'fixed', data={'k': k}))
+
+
+@bp.thread
+def dispatcher(prog, n, stream, alive, waiting):
+    crews, held = [], None
+    for k in range(n):
+        yield sync(request=TEvent(stream.exponential(1.0), 'fault', data={'k': k}))
+        if held is not None:
+            prog.resume_bthread(held)
+            held = None
+        crews.append(prog.add_bthread(crew(k, stream)))
+        if k % cancel_every == 0 or len(crews) > 64:
+            while crews and not alive(prog, crews[0]):
+                crews.pop(0)
+            if crews:
+                prog.remove_bthread(crews.pop(0))
+        if k % hold_every == 0 and len(crews) > 1 and waiting(prog, crews[-2]):
+            held = crews[-2]
+            prog.suspend_bthread(held)
+    if held is not None:
+        prog.resume_bthread(held)
+
+
+class ListProgram(bp.BProgram):
+    '''Baseline: bppy tickets in a plain list, handles are the generators,
+    removal and suspension search the list; finished bthreads stay as
+    empty tickets, as in BProgram'''
+
+    def __init__(self, bthreads, strategy):
+        super().__init__(bthreads=bthreads, event_selection_strategy=strategy)
+        self.suspended = {}
+
+    def add_bthread(self, bt):
+        super().add_bthread(bt)
+        return bt
+
+    def position(self, bt):
+        return next(i for i, t in enumerate(self.tickets) if t.get('bt') is bt)
+
+    def remove_bthread(self, bt):
+        if bt in self.new_bt:
+            self.new_bt.remove(bt)
+            return
+        if self.suspended.pop(bt, None) is None:
+            self.tickets.pop(self.position(bt))
+
+    def suspend_bthread(self, bt):
+        self.suspended[bt] = self.tickets.pop(self.position(bt))
+
+    def resume_bthread(self, bt):
+        self.tickets.append(self.suspended.pop(bt))
+
+
+def alive_handle(prog, h):
+    return h in prog.handles or h in prog.queued
+
+def waiting_handle(prog, h):
+    return h in prog.handles and h not in prog.suspended and bool(prog.tickets[prog.handles[h]])
+
+def alive_list(prog, bt):
+    return bt in prog.new_bt or bt in prog.suspended or waiting_list(prog, bt)
+
+def waiting_list(prog, bt):
+    return any(t.get('bt') is bt for t in prog.tickets)
+
+
+class Counter(bp.PrintBProgramRunnerListener):
+
+    def __init__(self, prog, every):
+        super().__init__()
+        self.prog, self.every = prog, every
+        self.events, self.faults = 0, 0
+        self.max_tickets = 0
+        self.marks = [time.perf_counter()]
+
+    def starting(self, b_program):
+        pass
+
+    def ended(self, b_program):
+        pass
+
+    def event_selected(self, b_program, event):
+        self.events += 1
+        if event.name == 'fault':
+            self.faults += 1
+            self.max_tickets = max(self.max_tickets, len(self.prog.tickets))
+            if self.faults % self.every == 0:
+                self.marks.append(time.perf_counter())
+
+
+'''runs the churn scenario for n crews on the handle based program
+(ContextualBProgram with HeapAlarmEventSelection, indexed) or on the list
+baseline (BProgram with AlarmEventSelection); returns the wall time, events,
+the largest ticket list and the wall time per block of `every` crews'''
+def churn(n, baseline=False, seed=0, every=10 ** 4):
+    stream = np.random.default_rng(seed)
+    if baseline:
+        prog = ListProgram([], AlarmEventSelection(max_time=np.inf))
+        prog.bthreads = [dispatcher(prog, n, stream, alive_list, waiting_list)]
+    else:
+        prog = ContextualBProgram(GridState([], [], []), lambda context, e: False,
+                                  event_selection_strategy=HeapAlarmEventSelection(max_time=np.inf),
+                                  indexed=True)
+        prog.bthreads = [dispatcher(prog, n, stream, alive_handle, waiting_handle)]
+    counter = Counter(prog, every)
+    prog.listener = counter
+    start = time.perf_counter()
+    prog.run()
+    wall = time.perf_counter() - start
+    return {'crews': n, 'events': counter.events, 'wall': wall,
+            'us_per_crew': wall / n * 1e6, 'max_tickets': counter.max_tickets,
+            'block_walls': np.diff(counter.marks).round(3).tolist()}
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 5
+    r = churn(n)
+    print(f'handles:  {r["crews"]} crews, {r["events"]} events in {r["wall"]:.2f}s '
+          f'({r["us_per_crew"]:.0f} us a crew), at most {r["max_tickets"]} tickets')
+    print(f'          wall per {10 ** 4} crews {r["block_walls"]}')
+    for m in [200, 400, 800]:  # the baseline grows quadratically
+        r = churn(m, baseline=True, every=m)
+        print(f'baseline: {r["crews"]} crews, {r["events"]} events in {r["wall"]:.2f}s '
+              f'({r["us_per_crew"]:.0f} us a crew), at most {r["max_tickets"]} tickets')
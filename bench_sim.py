@@ -0,0 +1,137 @@
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import v4
+from fastsim import FastEngine
+from mc import EventCounter
+from v4_obj import AlarmEventSelection
+
+# model variants run as they are (seeded), their printed events are counted.
+# v1.py is left out: its clock fails once no timer is left (argmin of an
+# empty sequence), so its run does not end normally
+scripts = ['v2.py', 'v3.py', 'v4.py']
+
+script_wrapper = '''
+import contextlib, io, json, random, runpy, time, tracemalloc
+import numpy as np
+import bppy, scipy.stats  # imported before timing
+walls, events, error = [], [], None
+if {memory}:
+    tracemalloc.start()
+for _ in range({repeats}):
+    random.seed({seed})
+    np.random.seed({seed})
+    out = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(out):
+            runpy.run_path({path!r}, run_name='__main__')
+    except Exception as e:
+        error = repr(e)
+        break
+    walls.append(time.perf_counter() - start)
+    events.append(sum(1 for l in out.getvalue().splitlines() if l.startswith(('BEvent(', 'TEvent('))))
+peak = tracemalloc.get_traced_memory()[1] if {memory} else None
+print(json.dumps({{'walls': walls, 'peak': peak, 'events': events, 'error': error}}))
+'''
+
+# selection strategies / backends for the v4 model, fast counts timed events only
+engines = ['alarm', 'heap', 'heap_indexed', 'fast']
+
+default_grid = {'n_lines': [2, 8, 32], 'line_size': [3], 'max_time': [1000, 8760]}
+
+
+'''runs a script repeats times in a fresh interpreter and returns the
+median wall time with its interquartile range (a single run of a few ms is
+within run to run noise) and the median event count (v4.py draws fresh
+component streams every run); a failing script fails the benchmark'''
+def run_script(path, seed=0, memory=False, repeats=15):
+    code = script_wrapper.format(seed=seed, path=path, memory=memory, repeats=repeats)
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if out.returncode or not out.stdout.strip():
+        raise RuntimeError(f'{path} failed:\n{out.stderr}')
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    if result['error'] is not None:
+        raise RuntimeError(f'{path} failed: {result["error"]}')
+    q1, median, q3 = np.percentile(result['walls'], [25, 50, 75])
+    return {'wall': float(median), 'wall_iqr': float(q3 - q1), 'repeats': repeats,
+            'peak': result['peak'], 'events': float(np.median(result['events']))}
+
+
+def run_model(engine, factory, seed):
+    if engine == 'fast':
+        fast = FastEngine(factory)
+        start = time.perf_counter()
+        fast.simulate(seed)
+        return fast.events, time.perf_counter() - start
+    random.seed(seed)
+    counter = EventCounter()
+    prog = factory(listener=counter, seed=seed)
+    if engine == 'alarm':
+        prog.event_selection_strategy = AlarmEventSelection(max_time=factory.max_time)
+    prog.indexed = engine == 'heap_indexed'
+    start = time.perf_counter()
+    prog.run()
+    return counter.events, time.perf_counter() - start
+
+
+'''timing pass over all seeds, then a separate tracemalloc pass for peak memory'''
+def bench_model(engine, factory, seeds):
+    events, wall = 0, 0.0
+    for seed in seeds:
+        e, w = run_model(engine, factory, seed)
+        events += e
+        wall += w
+    tracemalloc.start()
+    run_model(engine, factory, seeds[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'events': events, 'wall': wall,
+            'events_per_s': events / wall if wall else None,
+            'wall_per_sim_hour': wall / (factory.max_time * len(seeds)),
+            'peak_kib': peak / 1024}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(grid=default_grid, engines=engines, seeds=(0, 1, 2), rates=None):
+    rates = rates or {'in_oper_f_r': 0.01, 'on_demand_f_r': 0.05}
+    results = {'meta': {'revision': git_revision(), 'python': platform.python_version(),
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seeds': list(seeds),
+                        'rates': rates},
+               'scripts': [], 'models': []}
+    for path in scripts:
+        row = {'script': path}
+        row.update(run_script(path, seeds[0]))
+        row['peak_kib'] = run_script(path, seeds[0], memory=True, repeats=1)['peak'] / 1024
+        del row['peak']
+        results['scripts'].append(row)
+        print(row, file=sys.stderr)
+    for n_lines in grid['n_lines']:
+        for line_size in grid['line_size']:
+            for max_time in grid['max_time']:
+                factory = v4.grid_factory(n_lines, line_size, max_time=max_time, **rates)
+                for engine in engines:
+                    row = {'engine': engine, 'n_lines': n_lines, 'line_size': line_size,
+                           'components': len(factory.cnames), 'max_time': max_time}
+                    row.update(bench_model(engine, factory, list(seeds)))
+                    results['models'].append(row)
+                    print(row, file=sys.stderr)
+    return results
+
+
+if __name__ == '__main__':
+    out = sys.argv[1] if len(sys.argv) > 1 else 'bench_results.json'
+    with open(out, 'w') as f:
+        json.dump(run_suite(), f, indent=1)
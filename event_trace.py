@@ -0,0 +1,105 @@
+import numpy as np
+import bppy as bp
+
+# one row per selected event, component/line ids are -1 when absent
+trace_dtype = np.dtype([('t', 'f8'), ('event', 'i2'), ('c', 'i4'), ('l', 'i4')])
+
+
+class TraceRecorder(bp.BProgramRunnerListener):
+    '''Records (sim_time, event name id, component id, line id) for every
+    selected event into preallocated column buffers. Full buffers are
+    flushed as chunks to a binary file (np.save records, read back with
+    load_trace), or kept in memory when no path is given. Component and line
+    ids are the GridState ids of the program context.'''
+
+    def __init__(self, path=None, chunk=65536):
+        super().__init__()
+        self.path = path
+        self.file = None
+        self.columns = {k: np.empty(chunk, dtype=trace_dtype[k]) for k in trace_dtype.names}
+        self.t, self.event, self.c, self.l = self.columns.values()
+        self.n = 0
+        self.chunks = []
+        self.names = {}  # event name -> id
+
+    def flush(self):
+        if self.n == 0:
+            return
+        chunk = np.empty(self.n, dtype=trace_dtype)
+        for k, column in self.columns.items():
+            chunk[k] = column[:self.n]
+        if self.file is not None:
+            np.save(self.file, chunk)
+        else:
+            self.chunks.append(chunk)
+        self.n = 0
+
+    def event_selected(self, b_program, event):
+        context = b_program.context
+        name_id = self.names.get(event.name)
+        if name_id is None:
+            name_id = self.names[event.name] = len(self.names)
+        n = self.n
+        self.t[n] = b_program.event_selection_strategy.elapsed
+        self.event[n] = name_id
+        self.c[n] = context.cid.get(event.data.get('c'), -1)
+        self.l[n] = context.lid.get(event.data.get('l'), -1)
+        self.n += 1
+        if self.n == len(self.t):
+            self.flush()
+
+    def starting(self, b_program):
+        if self.path is not None:
+            self.file = open(self.path, 'wb')
+
+    def ended(self, b_program):
+        self.flush()
+        if self.file is not None:
+            np.save(self.file, np.array(self.event_names(), dtype=str))
+            self.file.close()
+            self.file = None
+
+    def event_names(self):
+        return sorted(self.names, key=self.names.get)
+
+    # recorded rows and event names, for in memory traces
+    def records(self):
+        self.flush()
+        rows = np.concatenate(self.chunks) if self.chunks else np.empty(0, dtype=trace_dtype)
+        return rows, self.event_names()
+
+    def started(self, b_program):
+        pass
+
+    def super_step_done(self, b_program):
+        pass
+
+    def assertion_failed(self, b_program):
+        pass
+
+    def b_thread_added(self, b_program):
+        pass
+
+    def b_thread_removed(self, b_program):
+        pass
+
+    def b_thread_done(self, b_program):
+        pass
+
+    def halted(self, b_program):
+        pass
+
+
+'''reads a trace file written by TraceRecorder, returns (rows, event names)'''
+def load_trace(path):
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                a = np.load(f)
+            except EOFError:
+                break
+            chunks.append(a)
+    names = [str(n) for n in chunks.pop()] if chunks and chunks[-1].dtype.kind == 'U' else []
+    rows = np.concatenate(chunks) if chunks else np.empty(0, dtype=trace_dtype)
+    return rows, names
@@ -0,0 +1,559 @@
+import hashlib
+import pickle
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import v4
+from v4_obj import *
+
+
+class Choices:
+    '''Stands in for the random streams of an explored program. Delays are
+    irrelevant to the untimed abstraction (exponential returns its scale);
+    every on demand draw with 0 < p < 1 is a branch, answered from script
+    while it lasts and False after it. drawn counts the branching draws of
+    the current step, so the caller can enumerate the other outcomes. Draws
+    outside a step (replays while restoring) answer False, the requests
+    they lead to come from the checkpoint.'''
+
+    def __init__(self):
+        self.script = None
+        self.drawn = 0
+
+    def start(self, script):
+        self.script, self.drawn = script, 0
+
+    def stop(self):
+        self.script = None
+        return self.drawn
+
+    def exponential(self, scale):
+        return scale
+
+    def bernoulli(self, p):
+        if p <= 0 or p >= 1:
+            return p >= 1
+        if self.script is None:
+            return False
+        self.drawn += 1
+        return self.script[self.drawn - 1] if self.drawn <= len(self.script) else False
+
+    def get_state(self):
+        return None
+
+    def set_state(self, state):
+        pass
+
+
+def untimed(e):
+    return e.to_now() if isinstance(e, TEvent) else e
+
+def requests(statement):
+    request = statement.get('request')
+    if request is None:
+        return []
+    return [request] if isinstance(request, BEvent) else list(request)
+
+def blocks(statement, event):
+    block = statement.get('block')
+    if isinstance(block, BEvent):
+        return block == event
+    return block is not None and event in block
+
+
+class UntimedEventSelection(bp.SimpleEventSelectionStrategy):
+    '''Untimed abstraction of the alarm strategies. Untimed requests are
+    urgent, as they are at elapsed + 0; when there are none, any unblocked
+    timed request may come next, since with exponential delays every
+    pending deadline is the earliest with positive probability. Selected
+    events are untimed, and like HeapAlarmEventSelection statements are
+    matched against the untimed event (waitFor=t_passed never wakes).
+    The clock stays at 0 and there is no horizon.'''
+    rewrites_statements = False
+
+    def __init__(self):
+        super().__init__()
+        self.elapsed = 0
+        self.max_time = np.inf
+
+    def is_satisfied(self, event, statement):
+        event = untimed(event)
+        if blocks(statement, event):
+            return False
+        if any(untimed(e) == event for e in requests(statement)):
+            return True
+        wait = statement.get('waitFor')
+        if isinstance(wait, BEvent):
+            return wait == event
+        return wait is not None and event in wait
+
+    # selectable events in ticket order, so exploration does not depend on hash seeds
+    def selectable_events(self, statements):
+        now, timed = {}, {}
+        for statement in statements:
+            for e in requests(statement):
+                (timed if isinstance(e, TEvent) else now)[untimed(e)] = None
+        for events in (now, timed):
+            events = [e for e in events if not any(blocks(s, e) for s in statements)]
+            if events:
+                return events
+        return []
+
+    def remaining(self, statement):
+        return statement.get('request')
+
+
+'''canonical form of a bthread local or statement field. Components
+(unique names), events and keyed sets have a deterministic repr; objects
+that do not change during a run (streams, context, functions, opaque event
+sets) are reduced to their type'''
+def canonical(v):
+    if v is None or isinstance(v, (bool, int, float, str, Component, Flag, BEvent, KeyedEventSet)):
+        return repr(v)
+    if isinstance(v, (list, tuple)):
+        return '[' + ','.join(map(canonical, v)) + ']'
+    if isinstance(v, dict):
+        return '{' + ','.join(f'{canonical(k)}:{canonical(x)}' for k, x in v.items()) + '}'
+    return type(v).__name__
+
+'''position of a bthread: code position, the locals it had at its first
+statement (loop state such as line_manager's status) and its pending
+statement. Locals assigned later are not part of it; in this model they are
+either dead at the next statement or reflected in it (the component of a
+for loop in its request)'''
+def position(ticket, head):
+    if not ticket:
+        return None
+    frame = bthread_frame(ticket['bt'])
+    keys = head[1] if head is not None else ()
+    return (frame.f_lasti,
+            [canonical(frame.f_locals.get(k)) for k in keys],
+            [canonical(ticket.get(k)) for k in ('request', 'waitFor', 'block')])
+
+'''64 bit fingerprint of a state: context status vector (buffer bytes)
+plus the bthread positions (reprs of position)'''
+def fingerprint(buffer, positions):
+    h = hashlib.blake2b(buffer, digest_size=8)
+    h.update('\0'.join(positions).encode())
+    return int.from_bytes(h.digest(), 'little') or 1  # 0 marks empty slots
+
+
+class FingerprintSet:
+    '''Visited states kept only as 64 bit fingerprints (hash compaction) in
+    a fixed numpy open addressing table, 8 bytes a slot, so memory is set by
+    capacity and not by the size of the states. Two reachable states share
+    a fingerprint with probability about n^2 / 2^65, which would prune the
+    second one; add returns None once the table is full.'''
+
+    def __init__(self, capacity):
+        self.size = 1 << int(np.ceil(np.log2(max(capacity, 8) / 0.75)))
+        self.capacity = capacity
+        self.table = np.zeros(self.size, dtype=np.uint64)
+        self.mask = self.size - 1
+        self.count = 0
+
+    def add(self, fp):
+        table, mask = self.table, self.mask
+        i = fp & mask
+        fp = np.uint64(fp)
+        while True:
+            slot = table[i]
+            if slot == fp:
+                return False
+            if slot == 0:
+                break
+            i = (i + 1) & mask
+        if self.count == self.capacity:
+            return None
+        table[i] = fp
+        self.count += 1
+        return True
+
+    def __len__(self):
+        return self.count
+
+
+def label(e):
+    data = ','.join(f'{k}={v.name if isinstance(v, Component) else v}' for k, v in e.data.items())
+    return f'{e.name}({data})'
+
+
+'''program of factory under the untimed abstraction, at its initial state'''
+def build(factory):
+    choices = Choices()
+    streams = {(n, k): choices for n in factory.cnames for k in stream_kinds}
+    prog = factory(streams=streams, checkpoints=True)
+    prog.event_selection_strategy = UntimedEventSelection()
+    prog.indexed = True
+    prog.setup()
+    prog.load_new_bthreads()
+    return prog, choices
+
+
+class Expander:
+    '''A live program of factory under the untimed abstraction, moved from
+    state to state instead of rebuilt for every transition. A state is
+    (context buffer bytes, bthread keys); the key of a bthread is its replay
+    log (events received since its loop head) and pending request, packed
+    (pack_event), so keys are the same in every process. Moving to a state
+    copies the buffer and replays only the bthreads whose key differs from
+    the loaded one, from the start of their function (bp.thread restarts a
+    generator sent None); a transition then only reloads the bthreads it
+    advanced. A bthread error leaves its generator closed, so the program is
+    rebuilt after one.'''
+
+    def __init__(self, factory, invariants):
+        self.factory = factory
+        self.invariants = invariants
+        self.rebuild()
+
+    def rebuild(self):
+        self.prog, self.choices = build(self.factory)
+        prog = self.prog
+        self.context = prog.context
+        self.bts = [t['bt'] for t in prog.tickets]
+        self.slot_handles = list(prog.slot_handles)
+        self.events = {}  # packed event -> event of this program
+        self.packed = []  # event table position -> packed event
+        self.interned = {}  # key -> the same key, compared by identity
+        self.located = {}  # (bthread, key) -> position repr, replays are deterministic
+        self.advanced = set()
+        record = prog.record
+
+        def recording(i, m):
+            self.advanced.add(i)
+            record(i, m)
+        prog.record = recording
+        n = len(prog.tickets)
+        self.keys = [self.key(i) for i in range(n)]
+        self.positions = [None] * n
+        for i in range(n):
+            self.locate(i)
+
+    def event(self, packed):
+        e = self.events.get(packed)
+        if e is None:
+            e = self.events[packed] = unpack_event(packed, self.context)
+        return e
+
+    # position of an event in the program event table, as record keeps it
+    def event_id(self, packed):
+        prog, e = self.prog, self.event(packed)
+        eid = prog.event_ids.get(e)
+        if eid is None:
+            eid = prog.event_ids[e] = len(prog.event_table)
+            prog.event_table.append(e)
+        return eid
+
+    def key(self, i):
+        prog, context = self.prog, self.context
+        table = prog.event_table
+        while len(self.packed) < len(table):
+            self.packed.append(pack_event(table[len(self.packed)], context))
+        ticket = prog.tickets[i]
+        request = ticket.get('request')
+        if request is not None:
+            single = isinstance(request, BEvent)
+            request = single, tuple(pack_event(e, context) for e in ([request] if single else request))
+        key = tuple(self.packed[eid] for eid in prog.histories[i]), request
+        return self.interned.setdefault(key, key)
+
+    # replays bthread i to key
+    def load(self, i, key):
+        prog = self.prog
+        history, request = key
+        ticket = prog.tickets[i]
+        ticket.clear()
+        ticket['bt'] = self.bts[i]
+        handle = self.slot_handles[i]
+        prog.slot_handles[i], prog.handles[handle] = handle, i
+        prog.send(ticket, None)
+        prog.heads[i] = bthread_head(ticket)
+        for packed in history:
+            prog.send(ticket, self.event(packed))
+        if request is not None:
+            single, events = request
+            events = [self.event(p) for p in events]
+            ticket['request'] = events[0] if single else events
+        elif not ticket:  # done
+            prog.release(i)
+        prog.histories[i] = [self.event_id(p) for p in history]
+        if prog.use_index():
+            prog.reindex(i)
+        self.keys[i] = key
+        self.locate(i)
+
+    def locate(self, i):
+        located = (i, self.keys[i])
+        p = self.located.get(located)
+        if p is None:
+            p = self.located[located] = repr(position(self.prog.tickets[i], self.prog.heads[i]))
+        self.positions[i] = p
+
+    def move(self, state):
+        buffer, keys = state
+        self.context.buffer[:] = np.frombuffer(buffer, dtype=np.int64)
+        for i, key in enumerate(keys):
+            if self.keys[i] is not key and self.keys[i] != key:
+                self.load(i, self.interned.setdefault(key, key))
+
+    def state(self):
+        return self.context.buffer.tobytes(), tuple(self.keys)
+
+    def fingerprint(self):
+        return fingerprint(self.context.buffer.tobytes(), self.positions)
+
+    '''successors of a state, one per selectable event and on demand
+    outcome, as (fingerprint, state, event label); checks the invariants
+    {name: check(context, event)} on every transition (check gets the
+    context before the effect and returns whether it holds) and reports
+    violations and bthread errors as (name, event label)'''
+    def expand(self, state):
+        prog, choices = self.prog, self.choices
+        self.move(state)
+        events = prog.event_selection_strategy.selectable_events(prog.tickets)
+        successors, violations = [], []
+        for k in range(len(events)):
+            scripts = [[]]
+            while scripts:
+                script = scripts.pop()
+                self.move(state)
+                if self.prog is not prog:  # rebuilt after an error, events of the new program
+                    prog, choices = self.prog, self.choices
+                    events = prog.event_selection_strategy.selectable_events(prog.tickets)
+                e = events[k]
+                name = label(e)
+                violations.extend((check, name) for check, holds in self.invariants.items()
+                                  if not holds(self.context, e))
+                choices.start(script)
+                self.advanced.clear()
+                try:
+                    prog.effect(self.context, e)
+                    prog.advance_bthreads(prog.tickets, e)
+                    prog.load_new_bthreads()
+                except Exception as ex:
+                    violations.append((f'{type(ex).__name__}: {ex}', name))
+                    choices.stop()
+                    self.rebuild()
+                    continue
+                drawn = choices.stop()
+                scripts.extend(script + [False] * (j - len(script)) + [True]
+                               for j in range(len(script), drawn))
+                for i in self.advanced:
+                    self.keys[i] = self.key(i)
+                    self.locate(i)
+                successors.append((self.fingerprint(), self.state(), name))
+        return successors, violations
+
+
+expander = None  # of a worker process
+
+def start_worker(factory, invariants):
+    global expander
+    expander = Expander(factory, invariants)
+
+def expand_all(states):
+    return [expander.expand(state) for state in states]
+
+
+class Frontier:
+    '''States waiting for expansion, first in first out (bfs) or last in
+    first out (dfs). At most about memory items are kept in memory, the
+    rest is spilled to temporary files in blocks, so a large frontier costs
+    disk instead of memory.'''
+
+    def __init__(self, lifo=False, memory=10 ** 5):
+        self.lifo = lifo
+        self.block = max(memory // 3, 1)
+        self.head = deque()  # fifo: next items; lifo: the stack
+        self.tail = []  # fifo: items pushed after the spilled blocks
+        self.files = []  # spilled blocks, oldest first
+        self.count = 0
+
+    def spill(self, items):
+        f = tempfile.TemporaryFile()
+        pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.files.append(f)
+
+    def unspill(self, f):
+        f.seek(0)
+        items = pickle.load(f)
+        f.close()
+        return items
+
+    def push(self, item):
+        self.count += 1
+        if self.lifo:
+            self.head.append(item)
+            if len(self.head) > 2 * self.block:  # spills the bottom of the stack
+                self.spill([self.head.popleft() for _ in range(self.block)])
+            return
+        self.tail.append(item)
+        if len(self.tail) >= self.block:
+            if not self.files and len(self.head) < self.block:
+                self.head.extend(self.tail)
+            else:
+                self.spill(self.tail)
+            self.tail = []
+
+    def pop(self):
+        if not self.head:
+            if self.lifo:
+                self.head = deque(self.unspill(self.files.pop()))
+            elif self.files:
+                self.head = deque(self.unspill(self.files.pop(0)))
+            else:
+                self.head, self.tail = deque(self.tail), []
+        self.count -= 1
+        return self.head.pop() if self.lifo else self.head.popleft()
+
+    def __len__(self):
+        return self.count
+
+
+'''system_down is not selected while some line is functional'''
+def down_only_when_all_broken(context, event):
+    return event.name != 'system_down' or not any(
+        context.line(l) != Status.BROKEN for l in context.l_names)
+
+'''a broken line is not asked to start'''
+def no_start_of_broken_line(context, event):
+    return event.name != 'line_req_on' or context.line(event.data['l']) != Status.BROKEN
+
+default_invariants = {'system_down while a line is functional': down_only_when_all_broken,
+                      'line_req_on of a broken line': no_start_of_broken_line}
+
+
+class Explorer:
+    '''Exhaustive exploration of the untimed abstraction of a v4 model
+    (UntimedEventSelection): every interleaving of the events the alarm
+    strategies could select and every on demand failure outcome. States
+    are expanded on a live program (Expander) and kept in the frontier in
+    compact form: the context buffer, one integer per bthread (its key in
+    a table of the distinct bthread keys) and the event labels leading to
+    it. Visited states are kept as 64 bit fingerprints in a FingerprintSet
+    of max_states entries and the frontier keeps about frontier_memory
+    states in memory, spilling the rest to disk, so memory is bounded by
+    max_states, frontier_memory and the number of distinct bthread keys
+    (a bthread's own states, far fewer than the product).
+    order is 'bfs' or 'dfs'; workers > 1 expands breadth first batches of
+    the frontier in a process pool (one live program per worker), chunk
+    states a task, visiting them in the serial bfs order. run() returns
+    the counts of states, transitions and terminal states (no selectable
+    event), the violated invariants with a shortest (bfs) counterexample
+    each, and whether the state space was exhausted.'''
+
+    def __init__(self, factory=None, invariants=None, order='bfs', workers=1,
+                 max_states=10 ** 6, max_depth=None, chunk=64, frontier_memory=10 ** 5):
+        if order not in ('bfs', 'dfs'):
+            raise ValueError(f'unknown order {order}')
+        self.factory = factory or v4.ModelFactory()
+        self.invariants = default_invariants if invariants is None else invariants
+        self.order = order
+        self.workers = workers
+        self.max_states = max_states
+        self.max_depth = max_depth
+        self.chunk = chunk
+        self.frontier_memory = frontier_memory
+
+    def run(self, verbose=False):
+        start = time.perf_counter()
+        self.visited = FingerprintSet(self.max_states)
+        self.transitions = 0
+        self.terminal = 0
+        self.deadlock = None  # trace of the first terminal state
+        self.violations = {}  # name -> trace of the first violation
+        self.complete = True
+        self.depth = 0
+        self.key_ids, self.key_table = {}, []
+        self.labels = {}
+        expander = Expander(self.factory, self.invariants)
+        self.visited.add(expander.fingerprint())
+        frontier = Frontier(lifo=self.order == 'dfs' and self.workers == 1,
+                            memory=self.frontier_memory)
+        frontier.push(self.compact(expander.state(), ()))
+        if self.workers == 1:
+            self.serial(expander, frontier, verbose)
+        else:
+            self.parallel(frontier, verbose)
+        return {'states': len(self.visited), 'transitions': self.transitions,
+                'terminal': self.terminal, 'depth': self.depth, 'complete': self.complete,
+                'deadlock': list(self.deadlock) if self.deadlock is not None else None,
+                'violations': {k: list(v) for k, v in self.violations.items()},
+                'seconds': time.perf_counter() - start}
+
+    # frontier item of a state: buffer, bthread key ids and trace
+    def compact(self, state, trace):
+        buffer, keys = state
+        ids = []
+        for key in keys:
+            k = self.key_ids.get(key)
+            if k is None:
+                k = self.key_ids[key] = len(self.key_table)
+                self.key_table.append(key)
+            ids.append(k)
+        return buffer, np.array(ids, dtype=np.int32).tobytes(), trace
+
+    def state(self, item):
+        buffer, ids, _ = item
+        return buffer, tuple(self.key_table[k] for k in np.frombuffer(ids, dtype=np.int32).tolist())
+
+    # adds the successors of a state, pushing the new ones to expand
+    def visit(self, item, result, frontier):
+        trace = item[2]
+        depth = len(trace)
+        successors, violations = result
+        self.depth = max(self.depth, depth)
+        for name, event in violations:
+            self.violations.setdefault(name, trace + (event,))
+        if not successors and not violations:
+            self.terminal += 1
+            self.deadlock = self.deadlock or trace
+        for fp, state, event in successors:
+            self.transitions += 1
+            added = self.visited.add(fp)
+            if added is None:
+                self.complete = False
+            elif added and (self.max_depth is None or depth < self.max_depth):
+                event = self.labels.setdefault(event, event)
+                frontier.push(self.compact(state, trace + (event,)))
+            elif added:
+                self.complete = False
+
+    def serial(self, expander, frontier, verbose):
+        while frontier:
+            item = frontier.pop()
+            self.visit(item, expander.expand(self.state(item)), frontier)
+            if verbose and len(self.visited) % 1000 == 0:
+                print(f'{len(self.visited)} states, frontier {len(frontier)}')
+
+    def parallel(self, frontier, verbose):
+        batch = self.chunk * self.workers * 4
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=start_worker,
+                                 initargs=(self.factory, self.invariants)) as pool:
+            while frontier:
+                items = [frontier.pop() for _ in range(min(batch, len(frontier)))]
+                chunks = [items[i:i + self.chunk] for i in range(0, len(items), self.chunk)]
+                results = pool.map(expand_all, [[self.state(item) for item in c] for c in chunks])
+                for c, chunk_results in zip(chunks, results):
+                    for item, result in zip(c, chunk_results):
+                        self.visit(item, result, frontier)
+                if verbose:
+                    print(f'depth {self.depth}: {len(self.visited)} states, frontier {len(frontier)}')
+
+
+if __name__ == '__main__':
+    import sys
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    for name, factory in [('init_line_one', v4.ModelFactory()),
+                          ('line_manager', v4.ModelFactory(manager=True))]:
+        result = Explorer(factory, workers=workers).run()
+        print(f'{name}: {result["states"]} states, {result["transitions"]} transitions, '
+              f'{result["terminal"]} terminal, depth {result["depth"]}, '
+              f'{"complete" if result["complete"] else "incomplete"}, {result["seconds"]:.1f}s')
+        if result['deadlock']:
+            print('  first terminal state after', ' '.join(result['deadlock']))
+        for violation, trace in result['violations'].items():
+            print(f'  {violation}:', ' '.join(trace))
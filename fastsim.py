@@ -0,0 +1,315 @@
+import copy
+import heapq
+import numpy as np
+import mc
+import v4
+from v4_obj import RandomStream, component_streams
+
+ON, OFF, BROKEN = 0, 1, 2
+O_FAIL, REPAIRED = 0, 1
+
+
+class FastEngine:
+    '''Runs the v4 component/line model as a direct discrete event loop,
+    without bthreads. Takes the same declarative inputs as v4.ModelFactory
+    and follows the bthread rules:
+      component_toggle  req_on/req_off fails on demand with on_demand_f_r,
+                        a request on a broken component is applied once it
+                        is repaired, requests meanwhile are missed
+      component_decay   o_fail after Exp(1/in_oper_f_r) while ON
+      component_repair  repaired after Exp(1/repair_rate), component OFF
+      line_status       line_fail / line_off / line_on from component events
+      disable_line_on_fail, start_line, init_line_one
+    restart=True re-enables the line_operational path of line_status and
+    restart_line (currently a no-op comparison in v4.line_status).
+    switchover=True applies the intended line_manager policy over the
+    priority order: on failure of the line in use start the next functional
+    one (system_down if none), and switch back to a higher priority line
+    once it is on.
+    Each component draws from the same seeded RandomStreams as the BP model.
+    simulate() returns the same result row as mc.run_replication, so an
+    engine can be passed to mc.run_batch as the factory.'''
+
+    def __init__(self, factory=None, restart=False, switchover=False, priority=None):
+        self.factory = factory or v4.ModelFactory(max_time=mc.YEAR)
+        self.restart = restart
+        self.switchover = switchover
+        self.priority = list(priority) if priority is not None \
+            else list(range(len(self.factory.l_names)))
+
+    @property
+    def max_time(self):
+        return self.factory.max_time
+
+    def simulate(self, seed=None):
+        run = Trajectory(self, seed)
+        run.run()
+        self.events = run.events  # timed events of the last run
+        return run.result()
+
+
+class Trajectory:
+    '''State of a single FastEngine run. Keeping the run in an object rather
+    than in a closure loop lets rare event estimators stop it once a number of
+    lines is broken, clone it, and weight it.
+    Failure biasing: while some line is broken, bias multiplies the
+    component failure rate and demand_bias the on demand failure
+    probability; running decay timers are redrawn when the biasing switches
+    (exponentials are memoryless). The log likelihood ratio of the
+    trajectory under the original model is accumulated in log_weight, a
+    decay timer contributes its density ratio when it fires and its survival
+    ratio when it is cancelled, redrawn, or still running at the end.
+    stop_at_down ends the run at the first system_down.'''
+
+    def __init__(self, engine, seed=None, bias=1.0, demand_bias=1.0, stop_at_down=False):
+        f = engine.factory
+        n_c, n_l = len(f.cnames), len(f.l_names)
+        streams = component_streams(f.cnames, seed)
+        self.decay_streams = [streams[n, 'decay'] for n in f.cnames]
+        self.repair_streams = [streams[n, 'repair'] for n in f.cnames]
+        self.toggle_streams = [streams[n, 'toggle'] for n in f.cnames]
+        self.max_time = f.max_time
+        self.rate = f.in_oper_f_r
+        self.decay_scale = 1 / f.in_oper_f_r
+        self.repair_scale = 1 / f.repair_rate
+        self.p = f.on_demand_f_r
+        self.members = f.line_members
+        self.comp_lines = [[l for l, m in enumerate(self.members) if c in m] for c in range(n_c)]
+        self.priority = engine.priority
+        self.rank = {l: r for r, l in enumerate(self.priority)}
+        self.restart, self.switchover = engine.restart, engine.switchover
+        self.stop_at_down = stop_at_down
+        self.bias = bias
+        self.demand_p = min(self.p * demand_bias, 1.0)
+        self.biased = bias != 1 or demand_bias != 1
+        self.active_bias = 1.0  # failure rate multiplier in effect
+        self.log_bias, self.excess_rate = 0.0, 0.0
+
+        self.state = [OFF] * n_c
+        self.line = [OFF] * n_l
+        self.pending = [None] * n_c  # toggle request waiting for repair
+        self.token = [0] * n_c  # invalidates the pending decay/repair timer
+        self.decay_start = [None] * n_c  # start of the running decay timer
+        self.heap = []
+        self.now = 0.0
+        self.first = {}
+        self.current, self.down = self.priority[0], False
+        self.broken = 0  # number of BROKEN lines
+        self.log_weight = 0.0
+        self.events = 0
+        self.done = False
+
+        self.set_line(self.priority[0], True)  # init_line_one / line_manager start
+        self.up = ON in self.line
+        self.up_time = 0.0
+
+    '''copy of the current state continuing with a fresh stream from seed,
+    shared by its components (clones are short lived, a small block and a
+    single generator keep cloning cheap)'''
+    def clone(self, seed=None, block=64):
+        new = copy.copy(self)
+        for k in ['state', 'line', 'pending', 'token', 'decay_start', 'heap']:
+            setattr(new, k, list(getattr(self, k)))
+        new.first = dict(self.first)
+        new.set_streams(RandomStream(seed, block))
+        return new
+
+    # draws every timer and on demand failure from a single stream
+    def set_streams(self, stream):
+        n_c = len(self.state)
+        self.decay_streams = self.repair_streams = self.toggle_streams = [stream] * n_c
+
+    def schedule(self, c, delay, kind):
+        self.token[c] += 1
+        heapq.heappush(self.heap, (self.now + delay, self.token[c], c, kind))
+
+    # switches the failure biasing on (some line broken) or off
+    def set_bias(self, on):
+        bias = self.bias if on else 1.0
+        if not self.biased or bias == self.active_bias:
+            return
+        running = [c for c, start in enumerate(self.decay_start) if start is not None]
+        for c in running:
+            self.censor(c, self.now)
+        self.active_bias = bias
+        self.decay_scale = 1 / (self.rate * bias)
+        self.log_bias, self.excess_rate = np.log(bias), (bias - 1) * self.rate
+        for c in running:
+            self.decay_start[c] = self.now
+            self.schedule(c, self.decay_streams[c].exponential(self.decay_scale), O_FAIL)
+
+    # likelihood ratio of a decay timer stopped before firing
+    def censor(self, c, end):
+        if self.biased and self.decay_start[c] is not None:
+            self.log_weight += self.excess_rate * (end - self.decay_start[c])
+        self.decay_start[c] = None
+
+    def toggle(self, c, on):
+        if self.pending[c] is not None:  # toggle bthread is busy
+            return
+        if self.biased and self.broken:
+            failed = self.toggle_streams[c].bernoulli(self.demand_p)
+            self.log_weight += np.log(self.p / self.demand_p) if failed \
+                else np.log((1 - self.p) / (1 - self.demand_p))
+        else:
+            failed = self.toggle_streams[c].bernoulli(self.p)
+        if self.state[c] == BROKEN:
+            if not failed:  # blocked until repaired
+                self.pending[c] = on
+            return
+        if failed:
+            self.censor(c, self.now)
+            self.fail(c)
+        elif on:
+            self.turn_on(c)
+        else:
+            self.turn_off(c)
+
+    def turn_on(self, c):
+        state = self.state
+        if state[c] != ON:
+            state[c] = ON
+            self.decay_start[c] = self.now
+            self.schedule(c, self.decay_streams[c].exponential(self.decay_scale), O_FAIL)
+        for l in self.comp_lines[c]:
+            if all(state[i] == ON for i in self.members[l]):
+                self.line_on(l)
+
+    def turn_off(self, c):
+        if self.state[c] == ON:
+            self.token[c] += 1  # decay waits for off
+            self.censor(c, self.now)
+        self.state[c] = OFF
+        for l in self.comp_lines[c]:
+            if self.line[l] == ON:
+                self.line[l] = OFF
+                self.line_available(l)
+
+    def decayed(self, c):
+        if self.biased:
+            self.log_weight += self.excess_rate * (self.now - self.decay_start[c]) - self.log_bias
+        self.decay_start[c] = None
+        self.fail(c)
+
+    def fail(self, c):
+        self.state[c] = BROKEN
+        self.schedule(c, self.repair_streams[c].exponential(self.repair_scale), REPAIRED)
+        for l in self.comp_lines[c]:
+            if self.line[l] != BROKEN:
+                self.line_fail(l)
+
+    def repaired(self, c):
+        self.state[c] = OFF
+        on, self.pending[c] = self.pending[c], None
+        if on:
+            self.turn_on(c)
+        if self.restart:
+            state, line = self.state, self.line
+            for l in self.comp_lines[c]:
+                if line[l] == BROKEN and all(state[i] != BROKEN for i in self.members[l]):
+                    line[l] = OFF
+                    self.broken -= 1
+                    if not self.broken:
+                        self.set_bias(False)
+                    if self.switchover:
+                        self.line_available(l)
+                    else:  # restart_line
+                        self.set_line(l, True)
+
+    def set_line(self, l, on):
+        for c in self.members[l]:
+            self.toggle(c, on)
+
+    def line_fail(self, l):
+        self.line[l] = BROKEN
+        self.broken += 1
+        self.set_bias(True)
+        self.first.setdefault('line_fail', self.now)
+        self.set_line(l, False)  # disable_line_on_fail
+        if self.switchover and l == self.current:
+            for r in range(self.rank[l] + 1, len(self.line)):
+                nxt = self.priority[r]
+                if self.line[nxt] != BROKEN:
+                    self.current = nxt
+                    self.set_line(nxt, True)
+                    return
+            self.down = True
+            self.first.setdefault('system_down', self.now)
+
+    def line_available(self, l):
+        if self.switchover and (self.down or self.rank[l] <= self.rank[self.current]):
+            self.current, self.down = l, False
+            self.set_line(l, True)
+
+    def line_on(self, l):
+        self.line[l] = ON
+        current = self.current
+        if self.switchover and self.rank[l] < self.rank[current]:
+            self.current = l
+            self.set_line(current, False)
+
+    '''processes timed events until the horizon (or system_down with
+    stop_at_down), until stop_level lines are broken or until fewer than
+    floor lines are. returns whether the run is done'''
+    def run(self, stop_level=None, floor=0):
+        heap, token = self.heap, self.token
+        while heap:
+            t, tok, c, kind = heapq.heappop(heap)
+            if tok != token[c]:
+                continue
+            if t > self.max_time:
+                break
+            self.events += 1
+            if self.up:
+                self.up_time += t - self.now
+            self.now = t
+            if kind == O_FAIL:
+                self.decayed(c)
+            else:
+                self.repaired(c)
+            self.up = ON in self.line
+            if self.stop_at_down and self.down:
+                self.finish(t)
+                return True
+            if stop_level is not None and self.broken >= stop_level or self.broken < floor:
+                return False
+        self.finish(self.max_time)
+        return True
+
+    def finish(self, end):
+        if self.up:
+            self.up_time += end - self.now
+        self.now = end
+        for c in range(len(self.state)):
+            self.censor(c, end)
+        self.done = True
+
+    '''same row as mc.run_replication'''
+    def result(self):
+        return [self.up_time / self.max_time] + \
+            [self.first.get(n, np.nan) for n in mc.first_passage_events]
+
+
+'''runs the BP model and the fast engine on the same seeds and compares
+their estimates; differences should fall within the combined intervals'''
+def validate(n=2000, seed=0, factory=None, workers=1):
+    factory = factory or v4.ModelFactory(max_time=mc.YEAR)
+    bp_summary = mc.run_batch(n, seed, factory=factory, workers=workers)
+    fast_summary = mc.run_batch(n, seed, factory=FastEngine(factory), workers=workers)
+    rows = []
+    for metric in ['availability'] + [f'time_to_{e}' for e in mc.first_passage_events]:
+        a, b = bp_summary[metric], fast_summary[metric]
+        diff = abs(a['mean'] - b['mean'])
+        rows.append((metric, a['mean'], b['mean'], diff, a['ci'] + b['ci']))
+    return rows
+
+
+if __name__ == '__main__':
+    import time
+    engine = FastEngine(v4.ModelFactory(max_time=mc.YEAR))
+    start = time.perf_counter()
+    summary = mc.run_batch(100000, factory=engine)
+    print(f'{summary["replications"]} fast replications in {time.perf_counter() - start:.1f}s')
+    for metric, bp_mean, fast_mean, diff, ci in validate():
+        print(f'{metric:22s} bp {bp_mean:10.4f}  fast {fast_mean:10.4f}  '
+              f'diff {diff:8.4f}  ci {ci:8.4f}')
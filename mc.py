@@ -0,0 +1,433 @@
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+import numpy as np
+from scipy import stats
+import bppy as bp
+import v4
+from v4_obj import Status
+
+YEAR = 8760  # hours
+
+# events whose first occurrence time is recorded per replication
+first_passage_events = ['line_fail', 'system_down']
+
+
+class EventCounter(bp.PrintBProgramRunnerListener):
+    '''Counts the selected events of a run, printing nothing'''
+
+    def __init__(self):
+        super().__init__()
+        self.events = 0
+
+    def starting(self, b_program):
+        pass
+
+    def ended(self, b_program):
+        pass
+
+    def event_selected(self, b_program, event):
+        self.events += 1
+
+
+class ReliabilityListener(bp.BProgramRunnerListener):
+    '''Integrates system up time (some line ON) and records first passage
+    times, using the strategy clock at each selected event. start is the
+    clock at which observation begins, for warm started programs'''
+
+    def __init__(self, max_time, start=0):
+        super().__init__()
+        self.max_time = max_time
+        self.start = start
+        self.last_t = start
+        self.up = False
+        self.up_time = 0
+        self.first = {}
+
+    def advance(self, t):
+        t = min(t, self.max_time)
+        if self.up:
+            self.up_time += t - self.last_t
+        self.last_t = t
+
+    def result(self):
+        return [self.up_time / (self.max_time - self.start)] + \
+            [self.first.get(n, np.nan) for n in first_passage_events]
+
+    def event_selected(self, b_program, event):
+        t = b_program.event_selection_strategy.elapsed
+        self.advance(t)
+        self.up = b_program.context.any_line(Status.ON)
+        if event.name in first_passage_events and event.name not in self.first:
+            self.first[event.name] = t - self.start
+
+    def ended(self, b_program):
+        self.advance(self.max_time)
+
+    def starting(self, b_program):
+        self.up = b_program.context.any_line(Status.ON)
+
+    def started(self, b_program):
+        pass
+
+    def super_step_done(self, b_program):
+        pass
+
+    def assertion_failed(self, b_program):
+        pass
+
+    def b_thread_added(self, b_program):
+        pass
+
+    def b_thread_removed(self, b_program):
+        pass
+
+    def b_thread_done(self, b_program):
+        pass
+
+    def halted(self, b_program):
+        pass
+
+
+'''runs a single trajectory of the model built by factory (v4 by default),
+or of an engine providing simulate(seed) such as fastsim.FastEngine.
+with a snapshot (ContextualBProgram.checkpoint) the program is warm started
+from it and observed for max_time from there.
+returns [availability, *first passage times (nan if not reached)]'''
+def run_replication(seed, factory=None, snapshot=None):
+    factory = factory or v4.ModelFactory(max_time=YEAR)
+    if hasattr(factory, 'simulate'):
+        if snapshot is not None:
+            raise ValueError('warm starts need a BP model factory')
+        return factory.simulate(seed)
+    random.seed(seed)  # tie-breaking between simultaneous events
+    if snapshot is None:
+        listener = ReliabilityListener(factory.max_time)
+        prog = factory(listener=listener, seed=seed)
+    else:
+        start = snapshot['elapsed']
+        listener = ReliabilityListener(start + factory.max_time, start)
+        prog = factory(listener=listener, seed=seed, checkpoints=True)
+        prog.restore(snapshot, keep_streams=True)
+        prog.event_selection_strategy.max_time = start + factory.max_time
+    prog.run()
+    return listener.result()
+
+
+'''runs the model for warm_up time units and returns a checkpoint to warm
+start replications from'''
+def warm_up(factory, warm_up, seed=0):
+    random.seed(seed)
+    prog = factory(seed=seed, checkpoints=True)
+    prog.event_selection_strategy.max_time = np.inf
+    prog.run(until=warm_up)
+    return prog.checkpoint()
+
+
+'''worker task, runs a chunk of replications in a single process. engines
+providing simulate_batch(seeds) (vecsim.VectorEngine) get the whole chunk'''
+def run_chunk(factory, seeds, snapshot=None):
+    if hasattr(factory, 'simulate_batch') and snapshot is None:
+        return np.asarray(factory.simulate_batch(seeds), dtype=float)
+    return np.array([run_replication(s, factory, snapshot) for s in seeds], dtype=float)
+
+
+'''runs replications in process, chunk by chunk as iter_parallel splits
+them, so batch engines (which draw per chunk) give the same results with
+any number of workers'''
+def run_serial(factory, seeds, chunk=64, snapshot=None):
+    return np.concatenate([run_chunk(factory, seeds[i:i + chunk], snapshot)
+                           for i in range(0, len(seeds), chunk)])
+
+
+'''runs replications over a process pool, yielding (offset, results) per
+chunk as soon as it completes'''
+def iter_parallel(factory, seeds, workers=None, chunk=64, snapshot=None):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_chunk, factory, seeds[i:i + chunk], snapshot): i
+                   for i in range(0, len(seeds), chunk)}
+        for f in as_completed(futures):
+            yield futures[f], f.result()
+
+
+'''per replication seeds, independent streams spawned from a single seed'''
+def replication_seeds(n, seed=0):
+    return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(n)]
+
+
+def mean_ci(values, confidence=0.95):
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n == 0:
+        return np.nan, np.nan
+    mean = float(values.mean())
+    if n == 1:
+        return mean, np.inf
+    half = stats.t.ppf((1 + confidence) / 2, n - 1) * values.std(ddof=1) / np.sqrt(n)
+    return mean, float(half)
+
+
+class OnlineMoments:
+    '''Count, mean and sum of squared deviations of a stream of values,
+    merged a chunk at a time (Chan et al.), so no values are kept'''
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        n = len(values)
+        if n == 0:
+            return
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    def ci(self, confidence=0.95):
+        if self.n == 0:
+            return np.nan, np.nan
+        if self.n == 1:
+            return float(self.mean), np.inf
+        std = np.sqrt(self.m2 / (self.n - 1))
+        half = stats.t.ppf((1 + confidence) / 2, self.n - 1) * std / np.sqrt(self.n)
+        return float(self.mean), float(half)
+
+
+class RunningSummary:
+    '''summarize() kept up to date from chunks of replication results'''
+
+    def __init__(self):
+        self.replications = 0
+        self.availability = OnlineMoments()
+        self.reached = {name: OnlineMoments() for name in first_passage_events}
+        self.times = {name: OnlineMoments() for name in first_passage_events}
+
+    def add(self, results):
+        results = np.asarray(results, dtype=float)
+        self.replications += len(results)
+        self.availability.add(results[:, 0])
+        for i, name in enumerate(first_passage_events, start=1):
+            times = results[:, i]
+            self.reached[name].add(~np.isnan(times))
+            self.times[name].add(times[~np.isnan(times)])
+
+    def summary(self, confidence=0.95):
+        summary = {'replications': self.replications}
+        mean, half = self.availability.ci(confidence)
+        summary['availability'] = {'mean': mean, 'ci': half}
+        for name in first_passage_events:
+            p, p_half = self.reached[name].ci(confidence)
+            mean, half = self.times[name].ci(confidence)
+            summary[f'time_to_{name}'] = {'reached': p, 'reached_ci': p_half,
+                                          'mean': mean, 'ci': half,
+                                          'count': self.times[name].n}
+        return summary
+
+
+'''aggregates an (n x metrics) array of replication results.
+first passage times are censored at max_time, their mean is conditional
+on the event occurring within the horizon'''
+def summarize(results, confidence=0.95):
+    results = np.asarray(results, dtype=float)
+    summary = {'replications': len(results)}
+    mean, half = mean_ci(results[:, 0], confidence)
+    summary['availability'] = {'mean': mean, 'ci': half}
+    for i, name in enumerate(first_passage_events, start=1):
+        times = results[:, i]
+        reached = times[~np.isnan(times)]
+        p, p_half = mean_ci(~np.isnan(times), confidence)
+        mean, half = mean_ci(reached, confidence)
+        summary[f'time_to_{name}'] = {'reached': p, 'reached_ci': p_half,
+                                      'mean': mean, 'ci': half,
+                                      'count': len(reached)}
+    return summary
+
+
+'''runs n independent replications and returns aggregated estimates.
+workers=1 runs in process, otherwise chunks are spread over a process pool
+(None uses all cores); results do not depend on the number of workers.
+snapshot warm starts every replication from a checkpoint (see warm_up)'''
+def run_batch(n, seed=0, max_time=YEAR, confidence=0.95, factory=None,
+              workers=1, chunk=64, snapshot=None):
+    factory = factory or v4.ModelFactory(max_time=max_time)
+    seeds = replication_seeds(n, seed)
+    if workers == 1:
+        return summarize(run_serial(factory, seeds, chunk, snapshot), confidence)
+    results = np.empty((n, 1 + len(first_passage_events)))
+    for offset, chunk_results in iter_parallel(factory, seeds, workers, chunk, snapshot):
+        results[offset:offset + len(chunk_results)] = chunk_results
+    return summarize(results, confidence)
+
+
+'''(estimate, half width) of a metric in a summary: 'availability',
+'time_to_<event>' for the mean passage time, or 'time_to_<event>.reached'
+for the probability of the event within the horizon'''
+def metric_ci(summary, metric):
+    key, _, field = metric.partition('.')
+    entry = summary[key]
+    if field:
+        return entry[field], entry[f'{field}_ci']
+    return entry['mean'], entry['ci']
+
+
+'''per replication values of metric (see metric_ci) in an array of
+replication results, nan where a passage time was not reached'''
+def metric_values(results, metric):
+    key, _, field = metric.partition('.')
+    if key == 'availability':
+        return results[:, 0]
+    times = results[:, 1 + first_passage_events.index(key[len('time_to_'):])]
+    return (~np.isnan(times)).astype(float) if field == 'reached' else times
+
+
+'''runs every factory on the same replication seeds, so with the component
+streams keyed by name (common random numbers) the variants see the same
+failures and repairs wherever they share components, and compares each one
+to the baseline (the first by default) replication by replication.
+Per variant and metric it reports the paired difference with its
+confidence half width, the half width independent runs of the same size
+would give, and the variance reduction (var(a) + var(b)) / var(a - b).
+passage times are compared on the replications where both variants reach
+the event'''
+def compare_paired(factories, n=1000, seed=0, baseline=None, metrics=None,
+                   confidence=0.95, workers=1, chunk=64):
+    metrics = metrics or ['availability'] + \
+        [f'time_to_{e}.reached' for e in first_passage_events]
+    seeds = replication_seeds(n, seed)
+    results = {}
+    for name, factory in factories.items():
+        if workers == 1:
+            results[name] = run_serial(factory, seeds, chunk)
+        else:
+            results[name] = np.empty((n, 1 + len(first_passage_events)))
+            for offset, chunk_results in iter_parallel(factory, seeds, workers, chunk):
+                results[name][offset:offset + len(chunk_results)] = chunk_results
+    baseline = baseline if baseline is not None else next(iter(factories))
+    comparison = {}
+    for name in factories:
+        if name == baseline:
+            continue
+        rows = {}
+        for metric in metrics:
+            a = metric_values(results[baseline], metric)
+            b = metric_values(results[name], metric)
+            both = ~(np.isnan(a) | np.isnan(b))
+            a, b = a[both], b[both]
+            diff, half = mean_ci(b - a, confidence)
+            m = len(a)
+            if m > 1:
+                var_a, var_b, var_d = a.var(ddof=1), b.var(ddof=1), (b - a).var(ddof=1)
+                independent = stats.t.ppf((1 + confidence) / 2, m - 1) * np.sqrt((var_a + var_b) / m)
+                if var_d > 0:
+                    reduction = (var_a + var_b) / var_d
+                else:  # identical or constant values
+                    reduction = np.inf if var_a + var_b > 0 else np.nan
+            else:
+                independent, reduction = np.nan, np.nan
+            rows[metric] = {'baseline': float(a.mean()) if m else np.nan,
+                            'variant': float(b.mean()) if m else np.nan,
+                            'diff': diff, 'ci': half, 'independent_ci': float(independent),
+                            'variance_reduction': float(reduction), 'pairs': m}
+        comparison[name] = rows
+    return comparison
+
+
+'''seeds of replication_seeds(n, seed), handed out a chunk at a time'''
+def iter_seed_chunks(seed=0, chunk=64):
+    root = np.random.SeedSequence(seed)
+    while True:
+        yield [int(s.generate_state(1)[0]) for s in root.spawn(chunk)]
+
+
+'''runs replications in chunks until the confidence half width of metric
+(see metric_ci) is at most abs_tol, or rel_tol times the estimate, or until
+time_budget seconds or max_replications are spent (a finite cap by
+default, so a metric without an estimate, e.g. the time to an event that
+never occurs, cannot keep it running). Estimates are updated online,
+stopping is checked on completed chunks in seed order, so results do not
+depend on the number of workers (a time budget aside).
+returns the summary with the reason it stopped ('precision',
+'time_budget', 'max_replications', or 'no_estimate' when a tolerance was
+asked for and the half width is still undefined at the budget or cap)
+and the wall time'''
+def run_until(metric='availability', rel_tol=None, abs_tol=None, time_budget=None,
+              seed=0, max_time=YEAR, confidence=0.95, factory=None, workers=1,
+              chunk=64, min_replications=100, max_replications=10 ** 6, snapshot=None):
+    if time_budget is None and max_replications is None:
+        raise ValueError('a time_budget or max_replications is needed to bound the run')
+    factory = factory or v4.ModelFactory(max_time=max_time)
+    running = RunningSummary()
+    start = time.perf_counter()
+
+    def stop_reason():
+        n = running.replications
+        mean, half = metric_ci(running.summary(confidence), metric)
+        spent = None
+        if max_replications is not None and n >= max_replications:
+            spent = 'max_replications'
+        elif time_budget is not None and time.perf_counter() - start >= time_budget:
+            spent = 'time_budget'
+        if spent is not None:
+            tolerance = rel_tol is not None or abs_tol is not None
+            return 'no_estimate' if tolerance and np.isnan(half) else spent
+        if n < min_replications or np.isnan(half):
+            return None
+        if abs_tol is not None and half <= abs_tol:
+            return 'precision'
+        if rel_tol is not None and half <= rel_tol * abs(mean):
+            return 'precision'
+        return None
+
+    def chunk_size():
+        if max_replications is None:
+            return chunk
+        return max(min(chunk, max_replications - submitted), 0)
+
+    seeds = iter_seed_chunks(seed, chunk)
+    submitted = 0
+    reason = None
+    if workers == 1:
+        while reason is None:
+            chunk_seeds = next(seeds)[:chunk_size()]
+            submitted += len(chunk_seeds)
+            running.add(run_chunk(factory, chunk_seeds, snapshot))
+            reason = stop_reason()
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            in_flight = {}  # future -> chunk number
+            done = {}  # completed chunks waiting for their predecessors
+            next_chunk = submitted_chunks = 0
+            while reason is None:
+                while len(in_flight) < 2 * (workers or os.cpu_count()) and chunk_size() > 0:
+                    chunk_seeds = next(seeds)[:chunk_size()]
+                    in_flight[pool.submit(run_chunk, factory, chunk_seeds, snapshot)] = submitted_chunks
+                    submitted_chunks += 1
+                    submitted += len(chunk_seeds)
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    done[in_flight.pop(f)] = f.result()
+                while reason is None and next_chunk in done:
+                    running.add(done.pop(next_chunk))
+                    next_chunk += 1
+                    reason = stop_reason()
+            pool.shutdown(cancel_futures=True)
+    summary = running.summary(confidence)
+    summary['stopped'] = reason
+    summary['wall'] = time.perf_counter() - start
+    return summary
+
+
+if __name__ == '__main__':
+    import time
+    start = time.perf_counter()
+    summary = run_batch(1000, seed=0, max_time=YEAR, workers=None)
+    print(f'{summary["replications"]} replications in {time.perf_counter() - start:.1f}s')
+    for k, v in summary.items():
+        print(k, v)
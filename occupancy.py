@@ -0,0 +1,162 @@
+import numpy as np
+from v4_obj import Status
+
+states = list(Status)  # ON, OFF, BROKEN, columns of the occupancy arrays
+column = {s.value: k for k, s in enumerate(states)}
+ON, BROKEN = column[Status.ON.value], column[Status.BROKEN.value]
+
+# outage duration bins (hours), log spaced; durations past the last edge
+# fall in the last bin
+outage_edges = np.concatenate([[0.0], np.geomspace(1e-3, 1e5, 33)])
+
+
+class Histogram:
+    '''Streaming histogram over fixed bin edges, with count, sum and max'''
+
+    def __init__(self, edges=outage_edges, rows=None):
+        self.edges = np.asarray(edges, dtype=float)
+        shape = (len(self.edges),) if rows is None else (rows, len(self.edges))
+        self.counts = np.zeros(shape, dtype=np.int64)
+        shape = () if rows is None else (rows,)
+        self.total = np.zeros(shape)
+        self.max = np.zeros(shape)
+
+    def add(self, x, row=None):
+        k = int(np.searchsorted(self.edges, x, side='right')) - 1
+        key = k if row is None else (row, k)
+        self.counts[key] += 1
+        idx = () if row is None else row
+        self.total[idx] += x
+        self.max[idx] = max(self.max[idx], x)
+
+
+class Occupancy:
+    '''Time weighted state occupancy of a ContextualBProgram, accumulated
+    online from the status changes its effect makes to the context
+    (GridState.observer), timed by the strategy clock (elapsed). Per
+    component and line it keeps the time spent in each Status and the
+    transition counts between them, plus streaming histograms of line
+    outages (time BROKEN) and of system outages (no line ON once some line
+    has been ON; start up counts as down time only), so memory does
+    not grow with the run length and no trace is kept. An entity's time is
+    only added up when it changes, a change costs O(1).
+    Attach before running (or after restore), call finish() once the run
+    has ended.'''
+
+    def __init__(self, prog, edges=outage_edges):
+        context = prog.context
+        self.strategy = prog.event_selection_strategy
+        n_c, n_l = len(context.comps), len(context.l_names)
+        self.c_time = np.zeros((n_c, len(states)))
+        self.l_time = np.zeros((n_l, len(states)))
+        self.c_transitions = np.zeros((n_c, len(states), len(states)), dtype=np.int64)
+        self.l_transitions = np.zeros((n_l, len(states), len(states)), dtype=np.int64)
+        self.line_outages = Histogram(edges, rows=n_l)
+        self.system_outages = Histogram(edges)
+        self.start = self.now()
+        self.c_since = np.full(n_c, self.start, dtype=float)
+        self.l_since = np.full(n_l, self.start, dtype=float)
+        self.c_status = [column[int(s)] for s in context.c_status]
+        self.l_status = [column[int(s)] for s in context.l_status]
+        self.lines_on = self.l_status.count(ON)
+        self.down_since = None if self.lines_on else self.start
+        self.been_up = bool(self.lines_on)  # down before the first line_on is start up, not an outage
+        self.down_time = 0.0
+        self.end = None
+        self.context = context
+        context.observer = self
+
+    def now(self):
+        return self.strategy.elapsed
+
+    def component_changed(self, i, old, new):
+        t = self.now()
+        old, new = column[old], column[new]
+        self.c_time[i, old] += t - self.c_since[i]
+        self.c_since[i] = t
+        self.c_transitions[i, old, new] += 1
+        self.c_status[i] = new
+
+    def line_changed(self, i, old, new):
+        t = self.now()
+        old, new = column[old], column[new]
+        self.l_time[i, old] += t - self.l_since[i]
+        if old == BROKEN:
+            self.line_outages.add(t - self.l_since[i], i)
+        self.l_since[i] = t
+        self.l_transitions[i, old, new] += 1
+        self.l_status[i] = new
+        self.lines_on += (new == ON) - (old == ON)
+        if self.lines_on == 0 and self.down_since is None:
+            self.down_since = t
+        elif self.lines_on and self.down_since is not None:
+            self.down_time += t - self.down_since
+            if self.been_up:
+                self.system_outages.add(t - self.down_since)
+            self.been_up = True
+            self.down_since = None
+
+    '''closes the accumulators at end (the strategy max_time by default) and
+    detaches from the context. Outages still running at the end count in the
+    state times but not in the outage histograms (they are censored)'''
+    def finish(self, end=None):
+        end = self.strategy.max_time if end is None else end
+        for i, k in enumerate(self.c_status):
+            self.c_time[i, k] += end - self.c_since[i]
+        for i, k in enumerate(self.l_status):
+            self.l_time[i, k] += end - self.l_since[i]
+        if self.down_since is not None:
+            self.down_time += end - self.down_since
+        self.c_since[:] = end
+        self.l_since[:] = end
+        self.end = end
+        self.context.observer = None
+
+    def availability(self):
+        return 1 - self.down_time / (self.end - self.start)
+
+    '''fractions of time per Status name for every component and line,
+    transition counts and outage statistics'''
+    def summary(self):
+        span = self.end - self.start
+        names = [s.name for s in states]
+        fractions = lambda times, labels: {
+            label: dict(zip(names, (row / span).tolist())) for label, row in zip(labels, times)}
+        context = self.context
+        outages = self.system_outages
+        return {
+            'availability': self.availability(),
+            'down_time': self.down_time,
+            'system_outages': {'count': int(outages.counts.sum()), 'total': float(outages.total),
+                               'max': float(outages.max)},
+            'lines': fractions(self.l_time, context.l_names),
+            'components': fractions(self.c_time, [c.name for c in context.comps]),
+            'line_failures': dict(zip(context.l_names, self.l_transitions[:, :, BROKEN].sum(axis=1).tolist())),
+            'component_failures': dict(zip([c.name for c in context.comps],
+                                            self.c_transitions[:, :, BROKEN].sum(axis=1).tolist())),
+        }
+
+
+if __name__ == '__main__':
+    import random
+    import sys
+    import time
+    import mc
+    import v4
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 1e5
+    # lines restart after repair and fail on demand rarely, so the run goes
+    # through many outages instead of staying down after the first one
+    factory = v4.grid_factory(3, 2, max_time=hours, in_oper_f_r=0.01,
+                              on_demand_f_r=1e-3, restart=True)
+    random.seed(0)
+    listener = mc.ReliabilityListener(hours)
+    prog = factory(listener=listener, seed=0)
+    occupancy = Occupancy(prog)
+    start = time.perf_counter()
+    prog.run()
+    occupancy.finish()
+    summary = occupancy.summary()
+    print(f'{hours:.0f} hours in {time.perf_counter() - start:.1f}s, availability '
+          f'{summary["availability"]:.6f} (listener {listener.result()[0]:.6f})')
+    for k, v in summary.items():
+        print(k, v)
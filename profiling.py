@@ -0,0 +1,154 @@
+import time
+
+
+class ProfiledBThread:
+    '''Stands in for a bthread generator in the program tickets, timing each
+    resume under the name of the function it was built from'''
+    __slots__ = ['bt', 'name', 'profiler']
+
+    def __init__(self, bt, profiler):
+        self.bt = bt
+        self.profiler = profiler
+        frame = bt.gi_frame
+        func = frame.f_locals.get('func') if frame is not None else None  # bp.thread wrapper
+        self.name = getattr(func, '__name__', None) or bt.__name__
+        profiler.bthread_names.add(self.name)
+
+    def send(self, m):
+        return self.profiler.call(self.name, self.bt.send, m)
+
+    def close(self):
+        self.bt.close()
+
+    @property
+    def gi_frame(self):
+        return self.bt.gi_frame
+
+
+class Profiler:
+    '''Opt-in instrumentation of a ContextualBProgram: attach() wraps the
+    selection strategy phases (select, selectable_events, is_satisfied,
+    advance_time), the program dispatch and effect, and every bthread, with
+    timers keyed by their call path; detach() removes them again. Nothing is
+    wrapped while the profiler is not attached, so an unprofiled run pays
+    nothing. Bthread resumes are reported per bthread function
+    (component_decay, line_status, ...).'''
+
+    strategy_phases = ['select', 'selectable_events', 'is_satisfied', 'advance_time']
+    program_phases = ['advance_bthreads', 'load_new_bthreads']
+
+    def __init__(self):
+        self.stack = []
+        self.paths = {}  # call path -> [calls, total time, time in callees]
+        self.bthread_names = set()
+        self.prog = None
+        self.effect = None
+
+    def call(self, name, f, *args):
+        stack = self.stack
+        stack.append(name)
+        path = tuple(stack)
+        start = time.perf_counter()
+        try:
+            return f(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            entry = self.paths.get(path)
+            if entry is None:
+                entry = self.paths[path] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            if stack:
+                self.paths.setdefault(tuple(stack), [0, 0.0, 0.0])[2] += elapsed
+
+    def wrap(self, name, f):
+        def wrapper(*args):
+            return self.call(name, f, *args)
+        return wrapper
+
+    def attach(self, prog):
+        self.prog = prog
+        strategy = prog.event_selection_strategy
+        for name in self.strategy_phases:
+            if hasattr(strategy, name):
+                setattr(strategy, name, self.wrap(name, getattr(strategy, name)))
+        for name in self.program_phases:
+            setattr(prog, name, self.wrap(name, getattr(prog, name)))
+        self.effect = prog.effect
+        prog.effect = self.wrap('effect', prog.effect)
+        prog.bthreads = [ProfiledBThread(bt, self) for bt in prog.bthreads or []]
+        prog.new_bt = [ProfiledBThread(bt, self) for bt in prog.new_bt]
+        for ticket in prog.tickets:
+            if ticket:
+                ticket['bt'] = ProfiledBThread(ticket['bt'], self)
+        return self
+
+    def detach(self):
+        prog = self.prog
+        for name in self.strategy_phases:
+            prog.event_selection_strategy.__dict__.pop(name, None)
+        for name in self.program_phases:
+            prog.__dict__.pop(name, None)
+        prog.effect = self.effect
+        unwrap = lambda bt: bt.bt if isinstance(bt, ProfiledBThread) else bt
+        prog.bthreads = [unwrap(bt) for bt in prog.bthreads or []]
+        prog.new_bt = [unwrap(bt) for bt in prog.new_bt]
+        for ticket in prog.tickets:
+            if ticket:
+                ticket['bt'] = unwrap(ticket['bt'])
+        self.prog = None
+
+    '''(name, calls, total s, self s) per phase or bthread function, summed
+    over call paths, by decreasing self time'''
+    def table(self):
+        rows = {}
+        for path, (calls, total, inner) in self.paths.items():
+            row = rows.setdefault(path[-1], [0, 0.0, 0.0])
+            row[0] += calls
+            row[2] += total - inner
+            if path[-1] not in path[:-1]:  # nested calls are in the outer total
+                row[1] += total
+        return sorted(((name, *row) for name, row in rows.items()),
+                      key=lambda r: -r[2])
+
+    # table rows of the bthread functions only
+    def bthreads(self):
+        return [row for row in self.table() if row[0] in self.bthread_names]
+
+    '''folded stacks (path;to;frame self-microseconds per line), as read by
+    flamegraph.pl and speedscope'''
+    def folded(self):
+        lines = []
+        for path, (calls, total, inner) in sorted(self.paths.items()):
+            self_us = int(round((total - inner) * 1e6))
+            if self_us > 0:
+                lines.append(f'{";".join(path)} {self_us}')
+        return '\n'.join(lines)
+
+    def format_table(self):
+        lines = [f'{"":28s} {"calls":>9s} {"total s":>9s} {"self s":>9s} {"us/call":>9s}']
+        for name, calls, total, self_time in self.table():
+            lines.append(f'{name:28s} {calls:9d} {total:9.3f} {self_time:9.3f} '
+                         f'{total / calls * 1e6:9.1f}')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import random
+    import sys
+    import v4
+    from v4_obj import AlarmEventSelection
+    factory = v4.grid_factory(10, 3, max_time=500, in_oper_f_r=0.02)
+    for legacy in [True, False]:
+        random.seed(0)
+        prog = factory(seed=0)
+        if legacy:
+            prog.event_selection_strategy = AlarmEventSelection(max_time=factory.max_time)
+        profiler = Profiler().attach(prog)
+        prog.run()
+        print(type(prog.event_selection_strategy).__name__)
+        print(profiler.format_table())
+        if len(sys.argv) > 1:  # python profiling.py stacks.folded
+            with open(sys.argv[1], 'w') as f:
+                f.write(profiler.folded())
@@ -0,0 +1,144 @@
+import time
+import numpy as np
+import mc
+import v4
+from fastsim import FastEngine, Trajectory
+from v4_obj import CType
+
+
+class ImportanceSampler:
+    '''Estimates P(system_down within the horizon) on a FastEngine with
+    failure biasing: while some line is broken component failure rates are
+    multiplied by bias and on demand failure probabilities by demand_bias,
+    each trajectory is weighted by its likelihood ratio under the original
+    model. bias=demand_bias=1 is crude Monte Carlo.
+    simulate(seed) returns [weighted indicator, timed events], so a sampler
+    can be run through mc.run_chunk / mc.iter_parallel.'''
+
+    def __init__(self, engine, bias=1.0, demand_bias=1.0):
+        self.engine = engine
+        self.bias = bias
+        self.demand_bias = demand_bias
+
+    def simulate(self, seed=None):
+        run = Trajectory(self.engine, seed, self.bias, self.demand_bias, stop_at_down=True)
+        run.run()
+        hit = 'system_down' in run.first
+        return [float(np.exp(run.log_weight)) if hit else 0.0, run.events]
+
+
+class Splitter:
+    '''Estimates P(system_down within the horizon) by multilevel splitting
+    on the number of broken lines (RESTART). A trajectory that reaches
+    thresholds[k] broken lines (1 .. n_lines - 1 by default) is split into
+    `splits` copies: itself and splits - 1 retrials continuing with fresh
+    streams, each carrying 1/splits of its weight. A retrial is dropped once
+    it falls back below the threshold it was born at, while the original
+    continues and takes the weight back, so effort is spent near the rare
+    states instead of on repaired trajectories. simulate(seed) returns
+    [weighted hits of the tree grown from one root trajectory, timed
+    events], optionally combined with failure biasing.'''
+
+    def __init__(self, engine, splits=4, thresholds=None, bias=1.0, demand_bias=1.0):
+        self.engine = engine
+        self.splits = splits
+        self.thresholds = list(thresholds) if thresholds is not None \
+            else list(range(1, len(engine.factory.l_names)))
+        self.bias = bias
+        self.demand_bias = demand_bias
+
+    def simulate(self, seed=None):
+        thresholds, splits = self.thresholds, self.splits
+        root = Trajectory(self.engine, seed, self.bias, self.demand_bias, stop_at_down=True)
+        clones = 0
+        total, events = 0.0, 0
+        stack = [(root, 0, 0, 1.0)]  # trajectory, level, level it was born at, weight
+        while stack:
+            run, k, born, weight = stack.pop()
+            start = run.events
+            done = run.run(thresholds[k] if k < len(thresholds) else None,
+                           thresholds[k - 1] if k else 0)
+            events += run.events - start
+            if done:
+                if 'system_down' in run.first:
+                    total += weight * np.exp(run.log_weight)
+                continue
+            while k and run.broken < thresholds[k - 1]:
+                if k == born:  # retrial left its level
+                    break
+                k -= 1
+                weight *= splits
+            else:
+                copies = [born]
+                while k < len(thresholds) and run.broken >= thresholds[k]:
+                    k += 1
+                    weight /= splits
+                    copies = [c for b in copies for c in [b] + [k] * (splits - 1)]
+                stack.append((run, k, copies[0], weight))
+                for b in copies[1:]:
+                    clones += 1
+                    stack.append((run.clone([seed or 0, clones]), k, b, weight))
+        return [float(total), events]
+
+
+'''runs n replications of a rare event sampler and reports the estimate, its
+confidence half width and relative error (standard error / estimate).
+work_relative_error scales the relative error to one timed event of work,
+for comparing methods at equal cost. ess, the effective sample size of the
+weights ((sum w)^2 / sum w^2, the hits for crude Monte Carlo), and
+max_weight_share, the share of the largest weight in the sum, flag heavy
+tailed weights, for which the interval is not to be trusted'''
+def estimate(sampler, n, seed=0, confidence=0.95, workers=1, chunk=64):
+    seeds = mc.replication_seeds(n, seed)
+    start = time.perf_counter()
+    if workers == 1:
+        results = mc.run_chunk(sampler, seeds)
+    else:
+        results = np.empty((n, 2))
+        for offset, chunk_results in mc.iter_parallel(sampler, seeds, workers, chunk):
+            results[offset:offset + len(chunk_results)] = chunk_results
+    wall = time.perf_counter() - start
+    values = results[:, 0]
+    mean, half = mc.mean_ci(values, confidence)
+    rel = float(values.std(ddof=1) / np.sqrt(n) / mean) if mean > 0 else np.inf
+    events = int(results[:, 1].sum())
+    total = values.sum()
+    ess = float(total ** 2 / (values ** 2).sum()) if total > 0 else 0.0
+    share = float(values.max() / total) if total > 0 else np.nan
+    return {'replications': n, 'estimate': mean, 'ci': half,
+            'relative_error': rel, 'hits': int(np.count_nonzero(values)),
+            'ess': ess, 'max_weight_share': share,
+            'events': events, 'wall': wall,
+            'work_relative_error': rel * np.sqrt(events)}
+
+
+'''crude Monte Carlo, importance sampling and splitting estimates of the
+same system_down probability. The default biasing is mild: on the 3 line
+standby model of the demo, bias=100, demand_bias=10 gave an effective sample
+size of a few weights and an interval missing the exact (ctmc) value,
+bias=10, demand_bias=3 covers it with the largest ess'''
+def compare(engine, n=10000, seed=0, bias=10.0, demand_bias=3.0, splits=8, workers=1):
+    samplers = {'crude': ImportanceSampler(engine),
+                'importance': ImportanceSampler(engine, bias, demand_bias),
+                'splitting': Splitter(engine, splits)}
+    return {name: estimate(s, n, seed, workers=workers) for name, s in samplers.items()}
+
+
+'''standby lines of independent components, no shared component, so that
+system_down needs every line to fail within the repair of the others'''
+def standby_factory(n_lines=2, line_size=2, **kwargs):
+    names = [f'c{i}_{j}' for i in range(n_lines) for j in range(line_size)]
+    members = [[i * line_size + j for j in range(line_size)] for i in range(n_lines)]
+    kwargs.setdefault('on_demand_f_r', 1e-3)
+    return v4.ModelFactory(names, [CType.CON] * len(names),
+                           [f'l{i + 1}' for i in range(n_lines)], members, **kwargs)
+
+
+if __name__ == '__main__':
+    engine = FastEngine(standby_factory(3, max_time=mc.YEAR), restart=True, switchover=True)
+    for name, r in compare(engine).items():
+        print(f'{name:10s} p {r["estimate"]:.3e} +- {r["ci"]:.1e}  '
+              f'rel err {r["relative_error"]:6.3f}  hits {r["hits"]:6d}  '
+              f'ess {r["ess"]:8.1f}  max w {r["max_weight_share"]:5.3f}  '
+              f'events {r["events"]:9d}  work rel err {r["work_relative_error"]:8.1f}  '
+              f'{r["wall"]:5.1f}s')
@@ -0,0 +1,176 @@
+import copy
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import fastsim
+import mc
+import v4
+import v4_obj
+import vecsim
+
+# modules whose source determines the results, part of every cache key
+engine_modules = [v4, v4_obj, mc, fastsim, vecsim]
+
+
+'''hash of the source of the engine modules, so cached results are not
+reused after the model or estimators change'''
+def engine_version(modules=None):
+    h = hashlib.sha256()
+    for module in modules or engine_modules:
+        h.update(inspect.getsource(module).encode())
+    return h.hexdigest()[:16]
+
+
+'''plain description of a model factory (or FastEngine) for hashing'''
+def describe(factory):
+    if hasattr(factory, 'simulate'):  # engine over a model factory
+        params = {k: v for k, v in vars(factory).items() if k not in ['factory', 'events']}
+        return {'engine': type(factory).__name__, **params, 'model': describe(factory.factory)}
+    params = dict(vars(factory))
+    params['ctypes'] = [t.name for t in factory.ctypes]
+    return {'model': type(factory).__name__, **params}
+
+
+'''content hash of a sweep point'''
+def point_key(factory, n, seed, version, chunk=64):
+    point = {'factory': describe(factory), 'replications': n, 'seed': seed, 'version': version}
+    if hasattr(factory, 'simulate_batch'):  # batch engines draw per chunk
+        point['chunk'] = chunk
+    return hashlib.sha256(json.dumps(point, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    '''Aggregated results on local disk, one json file per point key. Reading
+    an entry refreshes its modification time; once the files take more than
+    max_bytes the least recently used ones are evicted. Entries are written
+    to a temporary file and renamed, so an interrupted write leaves no
+    partial entry.'''
+
+    def __init__(self, path='.sweep_cache', max_bytes=64 * 2 ** 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, key):
+        return os.path.join(self.path, f'{key}.json')
+
+    def get(self, key):
+        try:
+            with open(self.file(key)) as f:
+                value = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        os.utime(self.file(key))
+        return value
+
+    def put(self, key, value):
+        tmp = self.file(key) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp, self.file(key))
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                st = os.stat(os.path.join(self.path, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries[:-1]:  # the newest entry stays
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+    def clear(self):
+        for _, _, name in self.entries():
+            os.remove(os.path.join(self.path, name))
+
+
+'''copy of factory (or of the model factory of an engine) with params set'''
+def with_params(factory, params):
+    new = copy.copy(factory)
+    if hasattr(factory, 'simulate'):
+        new.factory = with_params(factory.factory, params)
+        return new
+    for k, v in params.items():
+        if not hasattr(new, k):
+            raise ValueError(f'unknown model parameter {k}')
+        setattr(new, k, v)
+    return new
+
+
+'''runs n replications (seeds replication_seeds(n, seed)) at every point of
+the grid, {parameter: values} over the ModelFactory parameters
+(in_oper_f_r, on_demand_f_r, repair_rate, max_time, ...) of base (v4 by
+default, or a FastEngine), and returns [(params, summary)] in grid order.
+Points are looked up in cache by content hash of (topology, parameters,
+seed range, engine version, and the chunk size for batch engines, which
+draw per chunk); only missing points are run, chunk by chunk in process
+(workers=1) or spread over a process pool, and each point is stored as
+soon as all its chunks are done, so resuming an interrupted sweep only
+runs what is left'''
+def sweep(grid, base=None, n=1000, seed=0, cache=None, workers=1, chunk=64,
+          confidence=0.95, verbose=False):
+    base = base or v4.ModelFactory(max_time=mc.YEAR)
+    cache = cache if cache is not None else ResultCache()
+    version = engine_version()
+    names = list(grid)
+    points = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    factories = [with_params(base, p) for p in points]
+    keys = [point_key(f, n, seed, version, chunk) for f in factories]
+    summaries = [cache.get(k) for k in keys]
+    missing = [i for i, s in enumerate(summaries) if s is None]
+    if verbose:
+        print(f'{len(points) - len(missing)} of {len(points)} points cached')
+    seeds = mc.replication_seeds(n, seed)
+    start = time.perf_counter()
+
+    def store(i, results):
+        summaries[i] = mc.summarize(results, confidence)
+        cache.put(keys[i], summaries[i])
+        if verbose:
+            print(f'{points[i]} done at {time.perf_counter() - start:.1f}s')
+
+    if workers == 1:
+        for i in missing:
+            store(i, mc.run_serial(factories[i], seeds, chunk))
+    elif missing:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = {i: [None] * len(range(0, n, chunk)) for i in missing}
+            futures = {pool.submit(mc.run_chunk, factories[i], seeds[j:j + chunk]): (i, j // chunk)
+                       for i in missing for j in range(0, n, chunk)}
+            for f in as_completed(futures):
+                i, j = futures[f]
+                parts[i][j] = f.result()
+                if all(p is not None for p in parts[i]):
+                    store(i, [row for p in parts.pop(i) for row in p])
+    return list(zip(points, summaries))
+
+
+if __name__ == '__main__':
+    import sys
+    cache = ResultCache(sys.argv[1] if len(sys.argv) > 1 else '.sweep_cache')
+    grid = {'in_oper_f_r': [5e-4, 1e-3, 2e-3],
+            'on_demand_f_r': [0.01, 0.1],
+            'repair_rate': [0.1, 1.0]}
+    base = fastsim.FastEngine(v4.ModelFactory(max_time=mc.YEAR), restart=True, switchover=True)
+    for run in ['first', 'resumed']:
+        start = time.perf_counter()
+        rows = sweep(grid, base, n=2000, cache=cache, workers=None, verbose=True)
+        print(f'{run} sweep {time.perf_counter() - start:.2f}s')
+    for params, summary in rows:
+        print(params, f'availability {summary["availability"]["mean"]:.5f} '
+                      f'+- {summary["availability"]["ci"]:.5f}')
@@ -0,0 +1,44 @@
+import random
+import pytest
+import mc
+import v4
+from v4_obj import InternedEvent, TEvent, dump_checkpoint, load_checkpoint
+
+
+class TraceListener(mc.ReliabilityListener):
+
+    def __init__(self, max_time):
+        super().__init__(max_time)
+        self.trace = []
+
+    def event_selected(self, b_program, event):
+        self.trace.append(repr(event))
+        return super().event_selected(b_program, event)
+
+
+def build(factory, seed):
+    random.seed(seed)
+    prog = factory(seed=seed, checkpoints=True)
+    prog.listener = TraceListener(factory.max_time)
+    return prog
+
+
+@pytest.mark.parametrize('priority', [False, True])
+def test_restored_run_continues_the_trace(priority):
+    factory = v4.grid_factory(3, 2, max_time=3000, in_oper_f_r=0.01, on_demand_f_r=1e-3,
+                              restart=True, priority_selection=priority)
+    full = build(factory, 1)
+    full.run()
+    part = build(factory, 1)
+    part.run(until=300)
+    data = dump_checkpoint(part.checkpoint())  # before build reseeds the tie-breaking random
+    restored = build(factory, 1)
+    restored.restore(load_checkpoint(data))
+    requests = [t['request'] for t in restored.tickets if t and t.get('request') is not None]
+    # component and line events come back interned
+    assert requests and all(isinstance(r, InternedEvent) or
+                            isinstance(r, TEvent) and r.now is not None for r in requests)
+    restored.run()
+    assert part.listener.trace + restored.listener.trace == full.listener.trace
+    assert (restored.context.buffer == full.context.buffer).all()
+    assert restored.event_selection_strategy.elapsed == pytest.approx(full.event_selection_strategy.elapsed)
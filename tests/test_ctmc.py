@@ -0,0 +1,34 @@
+import pytest
+import mc
+import v4
+from ctmc import MarkovModel
+from fastsim import FastEngine
+
+engines = {
+    'v4': FastEngine(v4.ModelFactory(max_time=mc.YEAR)),
+    'v4 restart+switchover': FastEngine(v4.ModelFactory(max_time=mc.YEAR),
+                                        restart=True, switchover=True),
+    'grid 3x1 restart+switchover': FastEngine(
+        v4.grid_factory(3, 1, max_time=2000, in_oper_f_r=0.01, on_demand_f_r=0.1),
+        restart=True, switchover=True),
+    'grid 2x1 short horizon': FastEngine(
+        v4.grid_factory(2, 1, max_time=50, in_oper_f_r=0.01, on_demand_f_r=0.1),
+        restart=True, switchover=True),
+}
+
+
+# the exact values fall within the simulation intervals (seeded, so the
+# 99.9% intervals are fixed), up to one replication where every or no
+# replication reached an event and the interval is empty
+@pytest.mark.parametrize('name', list(engines))
+def test_ctmc_matches_simulation(name):
+    engine = engines[name]
+    model = MarkovModel(engine)
+    n = 4000
+    sim = mc.run_batch(n, seed=0, factory=engine, confidence=0.999)
+    exact = {'availability': model.mean_availability(),
+             'time_to_line_fail.reached': model.first_passage('line_fail'),
+             'time_to_system_down.reached': model.first_passage('system_down')}
+    for metric, value in exact.items():
+        mean, half = mc.metric_ci(sim, metric)
+        assert abs(mean - value) <= half + 1 / n, metric
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+import mc
+import v4
+from fastsim import FastEngine
+
+factories = {
+    'v4': v4.ModelFactory(max_time=mc.YEAR),
+    'grid 3x2': v4.grid_factory(3, 2, max_time=mc.YEAR, in_oper_f_r=1e-3, on_demand_f_r=0.01),
+}
+
+
+# both draw from the same seeded component streams, so rows are equal
+@pytest.mark.parametrize('name', list(factories))
+def test_fast_engine_matches_bp_rows(name):
+    factory = factories[name]
+    engine = FastEngine(factory)
+    seeds = mc.replication_seeds(100, 0)
+    bp_rows = np.array([mc.run_replication(seed, factory) for seed in seeds])
+    fast_rows = np.array([engine.simulate(seed) for seed in seeds])
+    np.testing.assert_allclose(fast_rows, bp_rows, rtol=1e-12, atol=1e-12)
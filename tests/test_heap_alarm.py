@@ -0,0 +1,57 @@
+import random
+import numpy as np
+import pytest
+import bppy as bp
+import mc
+import v4
+from v4_obj import AlarmEventSelection, TEvent
+
+
+class TraceListener(bp.PrintBProgramRunnerListener):
+
+    def __init__(self):
+        super().__init__()
+        self.trace = []
+
+    def starting(self, b_program):
+        pass
+
+    def ended(self, b_program):
+        pass
+
+    def event_selected(self, b_program, event):
+        now = event.to_now() if isinstance(event, TEvent) else event
+        self.trace.append((repr(now), b_program.event_selection_strategy.elapsed))
+
+
+# simultaneous events come in a strategy dependent order, pick by name
+def first_by_name(events):
+    return min(events, key=lambda e: repr(e.to_now() if isinstance(e, TEvent) else e))
+
+
+def run_trace(factory, seed, legacy):
+    listener = TraceListener()
+    prog = factory(listener=listener, seed=seed)
+    if legacy:
+        prog.event_selection_strategy = AlarmEventSelection(max_time=factory.max_time)
+    prog.run()
+    return listener.trace
+
+
+factories = {
+    'v4': v4.ModelFactory(max_time=mc.YEAR),
+    'grid 3x2': v4.grid_factory(3, 2, max_time=2000, in_oper_f_r=0.01, on_demand_f_r=0.05),
+    'grid 3x2 restart': v4.grid_factory(3, 2, max_time=2000, in_oper_f_r=0.01,
+                                        on_demand_f_r=0.05, restart=True),
+}
+
+
+@pytest.mark.parametrize('name', list(factories))
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_heap_matches_legacy_trace(monkeypatch, name, seed):
+    monkeypatch.setattr(random, 'choice', first_by_name)
+    factory = factories[name]
+    heap = run_trace(factory, seed, legacy=False)
+    legacy = run_trace(factory, seed, legacy=True)
+    assert [e for e, _ in heap] == [e for e, _ in legacy]
+    assert np.allclose([t for _, t in heap], [t for _, t in legacy])
@@ -0,0 +1,53 @@
+import mc
+import v4
+from fastsim import FastEngine
+from sweep import ResultCache, sweep
+
+grid = {'on_demand_f_r': [0.01, 0.1], 'repair_rate': [0.1, 1.0]}
+base = FastEngine(v4.ModelFactory(max_time=mc.YEAR), restart=True, switchover=True)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptingCache(ResultCache):
+    '''stops the sweep after `after` points are stored'''
+
+    def __init__(self, path, after):
+        super().__init__(path)
+        self.after = after
+
+    def put(self, key, value):
+        super().put(key, value)
+        self.after -= 1
+        if self.after == 0:
+            raise Interrupted
+
+
+def count_runs(monkeypatch):
+    runs = []
+    run_serial = mc.run_serial
+
+    def counting(factory, seeds, chunk=64, snapshot=None):
+        runs.append(factory)
+        return run_serial(factory, seeds, chunk, snapshot)
+    monkeypatch.setattr(mc, 'run_serial', counting)
+    return runs
+
+
+def test_resumed_sweep_runs_only_missing_points(tmp_path, monkeypatch):
+    expected = sweep(grid, base, n=200, cache=ResultCache(str(tmp_path / 'full')))
+    path = str(tmp_path / 'resumed')
+    try:
+        sweep(grid, base, n=200, cache=InterruptingCache(path, after=2))
+    except Interrupted:
+        pass
+    assert len(ResultCache(path).entries()) == 2
+    runs = count_runs(monkeypatch)
+    resumed = sweep(grid, base, n=200, cache=ResultCache(path))
+    assert len(runs) == 2
+    assert resumed == expected
+    runs.clear()
+    assert sweep(grid, base, n=200, cache=ResultCache(path)) == expected
+    assert runs == []
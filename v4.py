@@ -1,6 +1,5 @@
 
-import numpy as np
-from scipy.stats import expon
+from functools import partial
 from v4_obj import *
 
 in_oper_f_r = 10e-4  # per hour (exp)
@@ -11,52 +10,47 @@ cnames = ['grid', 'cb_up_1', 'transfo1']
 ctypes = [CType.SHARED, CType.CON, CType.SOURCE]
 l_names = ['l1', 'l2']
 
-comps = [Component(n, t) for n, t in zip(cnames, ctypes)]
-lines = [[c for c in l] for l in [comps[:2], comps[::2]]]
+line_members = [[0, 1], [0, 2]]  # component indices per line
 #t_c = line[0]
 
-
-context = {'c': {c: Status.OFF for c in comps},
-           'l': {l: Status.OFF for l in l_names}}
-
 def c_event(c, e_name, t=0):
     if t > 0:
-        return TEvent(t, e_name, data={'c': c})
-    return E(e_name, data={'c': c})
-l_event = lambda l, e_name: E(e_name, data={'l': l})
-ls_set = lambda ls: EventSet(lambda e: e.data.get('l') in ls)
-c_set = lambda c: EventSet(lambda e: e.data.get('c') == c)
+        return TEvent.of(component_event(c, e_name), t)
+    return component_event(c, e_name)
+l_event = lambda l, e_name: line_event(l, e_name)
+ls_set = lambda ls: keyed_set(ls=ls)
+c_set = lambda c: keyed_set(cs=[c])
 t_passed = EventSet(lambda e: isinstance(e, TEvent) and e.t > 0)
 
 
 '''Random failure during operation'''
 @bp.thread
-def component_decay(c, decay_scale):
+def component_decay(c, decay_scale, stream):
     while True:
         yield sync(waitFor=c_event(c, 'on'))
-        yield sync(request=c_event(c, 'o_fail', expon.rvs(scale=decay_scale)),
-                   waitFor=[c_event(c, 'd_fail'), c_event(c, 'off')])
+        yield sync(request=c_event(c, 'o_fail', stream.exponential(decay_scale)),
+                   waitFor=component_events(c, ['d_fail', 'off']))
 
 '''Requests repair after failure, blocks toggle when down'''
 @bp.thread
-def component_repair(c, repair_scale):
+def component_repair(c, repair_scale, stream):
+    failures = component_events(c, ['o_fail', 'd_fail'])
+    toggles = component_events(c, ['o_fail', 'on', 'off'])
     while True:
-        yield sync(waitFor=EventSet(
-            lambda e: ('fail' in e.name and e.data.get('c') == c)))
-        yield sync(request=c_event(c, 'req_repair'),
-                   block=[c_event(c, n) for n in ['o_fail', 'on', 'off']])
-        yield sync(request=c_event(c, 'repaired', expon.rvs(scale=repair_scale)),
-                   block=[c_event(c, n) for n in ['o_fail', 'on', 'off']])
+        yield sync(waitFor=failures)
+        yield sync(request=c_event(c, 'req_repair'), block=toggles)
+        yield sync(request=c_event(c, 'repaired', stream.exponential(repair_scale)),
+                   block=toggles)
 
 
 '''Induce potential failure on demand'''
 @bp.thread
-def component_toggle(c, on_demand_scale):
+def component_toggle(c, on_demand_scale, stream):
     while True:
-        e = yield sync(waitFor=[c_event(c, n) for n in ['req_on', 'req_off']])
+        e = yield sync(waitFor=component_events(c, ['req_on', 'req_off']))
         status_str = e.name.split('_')[1]
         new_status = Status.ON if status_str == 'on' else Status.OFF
-        failed_on_demand = np.random.rand() <= on_demand_scale
+        failed_on_demand = stream.bernoulli(on_demand_scale)
         event_name = 'd_fail' if failed_on_demand else status_str
         yield sync(request=c_event(c, event_name), waitFor=t_passed)
 
@@ -68,24 +62,26 @@ def restart_component(c):
         yield sync(waitFor=c_event(c, 'repaired'))
         yield sync(request=c_event(c, 'req_on', 10))
 
-'''updates line status according to component events'''
+'''updates line status according to component events. line_operational is
+only requested with restart (the original repaired branch was a no-op
+comparison)'''
 @bp.thread
-def line_status(name, line_comps):
+def line_status(name, line_comps, context, restart=False):
+    line_events = keyed_set(['on', 'off', 'repaired', 'o_fail', 'd_fail'],
+                            cs=line_comps)
     while True:
-        line_events = EventSet(lambda e: e.data.get('c') in line_comps
-                    and e.name in ['on', 'off', 'repaired', 'o_fail', 'd_fail'])
         e = yield sync(waitFor=line_events)
-        current_status = context['l'][name]
+        current_status = context.line(name)
         update_event = False
         if e.name in ['o_fail', 'd_fail'] and current_status != Status.BROKEN:
             update_event = 'line_fail'
         elif e.name == 'off' and current_status == Status.ON:
             update_event = 'line_off'
         elif e.name == 'repaired':
-            if not Status.BROKEN in [context['c'][line_c] for line_c in line_comps]:
-                update_event == 'line_operational'
+            if restart and not context.line_has_broken(name):
+                update_event = 'line_operational'
         elif e.name == 'on':
-            if all([context['c'][line_c] == Status.ON for line_c in line_comps]):
+            if context.line_all_on(name):
                 update_event = 'line_on'
         if update_event:
             yield sync(request=l_event(name, update_event),
@@ -141,7 +137,7 @@ def init_line_one(lines_names):
 @bp.thread
 def line_manager(lines_names):
     current_use = 0
-    status = context['l']
+    status = [Status.OFF] * len(lines_names)  # by line index, as find_next_functional reads it
     force_next = lambda e_name: {'request': E(e_name), 'block': AllExcept(E(e_name))} 
     # turn on first line at start
     yield sync(request=l_event(lines_names[current_use], 'line_req_on'))
@@ -178,7 +174,7 @@ def start(c):
 
 '''updates current context according to selected event.
 returns true if an update occured, false otherwise (potentially unnecessary)'''
-def context_effect(current, event):
+def context_effect(current, event, verbose=True):
     comp_updates = [(['o_fail', 'd_fail'], Status.BROKEN),
                     (['off', 'repaired'], Status.OFF),
                     (['on'], Status.ON)]
@@ -188,14 +184,16 @@ def context_effect(current, event):
     if event.data.get('c'):
         for events, status in comp_updates:
             if event.name in events:
-                current['c'][event.data['c']] = status
-                print(f'{event.data["c"]} <- {status}')
+                current.set_component(event.data['c'], status)
+                if verbose:
+                    print(f'{event.data["c"]} <- {status}')
                 return True
     elif event.data.get('l'):
         for events, status in line_updates:
             if event.name in events:
-                current['l'][event.data['l']] = status
-                print(f'{event.data["l"]} <- {status}')
+                current.set_line(event.data['l'], status)
+                if verbose:
+                    print(f'{event.data["l"]} <- {status}')
                 return True
     return False
 
@@ -203,29 +201,101 @@ def context_effect(current, event):
 def queryctx():
     pass
 
-bt_c_params = {
-    component_decay: [1 / in_oper_f_r],
-    component_repair: [1 / repair_rate],
-    component_toggle: [1/3],
-    #restart_component: [],
-    #start: []
-}
-
-l_bthreads = [
-    bt(lname, lcomp) for bt, (lname, lcomp) in itertools.product(
-            [line_status,
-             restart_line,
-             disable_line_on_fail,
-             start_line],
-            zip(l_names, lines))
-]
-c_bthreads = [
-    bt(c, *params)
-    for c, (bt, params) in itertools.product(comps, bt_c_params.items())
-]
-prog = ContextualBProgram(context=context,
-                          effect=context_effect,
-                          bthreads=c_bthreads + l_bthreads + [init_line_one(l_names)],
-                          listener=bp.PrintBProgramRunnerListener(),
-                          event_selection_strategy=AlarmEventSelection(max_time=300))
-prog.run()
+'''Picklable recipe of the model: topology, rates and horizon.
+Each call builds new components, context, bthreads and strategy, so
+several programs can live in one interpreter or be built in workers.
+manager=True starts the lines with the (WIP) line_manager instead of
+init_line_one; the engines only follow the default model.
+priority_selection=True selects with PriorityAlarmEventSelection, so
+simultaneous events follow the statement priorities and then request
+order instead of a random choice.
+restart=True makes line_status request line_operational once a broken
+line has no broken component, so restart_line starts it again'''
+class ModelFactory:
+
+    def __init__(self, cnames=cnames, ctypes=ctypes, l_names=l_names,
+                 line_members=line_members, in_oper_f_r=in_oper_f_r,
+                 on_demand_f_r=1/3, repair_rate=repair_rate, max_time=300, manager=False,
+                 priority_selection=False, restart=False):
+        self.cnames = list(cnames)
+        self.ctypes = list(ctypes)
+        self.l_names = list(l_names)
+        self.line_members = [list(m) for m in line_members]
+        self.in_oper_f_r = in_oper_f_r
+        self.on_demand_f_r = on_demand_f_r
+        self.repair_rate = repair_rate
+        self.max_time = max_time
+        self.manager = manager
+        self.priority_selection = priority_selection
+        self.restart = restart
+
+    def c_bthread_params(self):
+        return {
+            component_decay: [1 / self.in_oper_f_r],
+            component_repair: [1 / self.repair_rate],
+            component_toggle: [self.on_demand_f_r],
+            #restart_component: [],
+            #start: []
+        }
+
+    # random stream each component bthread draws from
+    c_bthread_streams = {component_decay: 'decay',
+                         component_repair: 'repair',
+                         component_toggle: 'toggle'}
+
+    # streams, when given, replaces the seeded component streams
+    def __call__(self, listener=None, verbose=False, seed=None, checkpoints=False, streams=None):
+        comps = [Component(n, t) for n, t in zip(self.cnames, self.ctypes)]
+        streams = streams if streams is not None else component_streams(self.cnames, seed)
+        lines = [[comps[i] for i in m] for m in self.line_members]
+        context = GridState(comps, self.l_names, lines)
+        l_bthreads = [
+            line_status(lname, lcomp, context, self.restart)
+            for lname, lcomp in zip(self.l_names, lines)
+        ] + [
+            bt(lname, lcomp) for bt, (lname, lcomp) in itertools.product(
+                    [restart_line,
+                     disable_line_on_fail,
+                     start_line,
+                     stop_line],
+                    zip(self.l_names, lines))
+        ]
+        c_bthreads = [
+            bt(c, *params, streams[c.name, self.c_bthread_streams[bt]])
+            for c, (bt, params) in itertools.product(comps, self.c_bthread_params().items())
+        ]
+        starter = line_manager(self.l_names) if self.manager else init_line_one(self.l_names)
+        effect = context_effect if verbose else partial(context_effect, verbose=False)
+        selection = PriorityAlarmEventSelection if self.priority_selection else HeapAlarmEventSelection
+        return ContextualBProgram(context=context,
+                                  effect=effect,
+                                  bthreads=c_bthreads + l_bthreads + [starter],
+                                  listener=listener,
+                                  event_selection_strategy=selection(max_time=self.max_time),
+                                  indexed=True,
+                                  streams=streams,
+                                  checkpoints=checkpoints)
+
+
+'''synthetic grid: a shared feed plus n_lines lines of line_size own components'''
+def grid_factory(n_lines, line_size, **kwargs):
+    names = ['grid'] + [f'c{i}_{j}' for i in range(n_lines) for j in range(line_size)]
+    types = [CType.SHARED] + [CType.CON] * (n_lines * line_size)
+    members = [[0] + [1 + i * line_size + j for j in range(line_size)]
+               for i in range(n_lines)]
+    return ModelFactory(names, types, [f'l{i + 1}' for i in range(n_lines)],
+                        members, **kwargs)
+
+
+def build_program(max_time=300, listener=None, verbose=True, seed=None):
+    return ModelFactory(max_time=max_time)(listener, verbose, seed)
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:  # python v4.py trace.npy, records a trace without printing
+        from event_trace import TraceRecorder
+        prog = build_program(max_time=300, listener=TraceRecorder(sys.argv[1]), verbose=False)
+    else:
+        prog = build_program(max_time=300, listener=bp.PrintBProgramRunnerListener())
+    prog.run()
@@ -4,32 +4,49 @@ from bppy.model.b_thread import *
 from bppy.model.event_set import *
 from collections.abc import Iterable
 from enum import auto, Flag
+from types import MappingProxyType
+import heapq
+import inspect
+import itertools
+import pickle
+import random
+import zlib
+import numpy as np
 
 E = bp.BEvent
 
 class TEvent(BEvent):
 
-    def __init__(self, t: float, name="", data={}):
+    def __init__(self, t: float, name="", data=None, now=None):
         super().__init__(name, data)
         self.t = float(t)
-        if not (t, float):
+        if self.t != self.t: # nan breaks ordering and equality
             raise ValueError('Inappropriate type for time') 
+        self.now = now  # interned untimed event, if any
 
     def __repr__(self):
         return super().__repr__() + f' t={self.t:.2f}'
 
     def __eq__(self, other):
-        if not super().__eq__(other): # different BEvents
+        if self.now is not None and isinstance(other, TEvent) and other.now is not None:
+            if not self.now == other.now:  # identity check between interned events
+                return False
+        elif not super().__eq__(other): # different BEvents
             return False
         if isinstance(other, TEvent): # time equiv
             return self.t == other.t
         return self.t == 0 # "now" TEvent to BEvent 
 
     def __hash__(self):
-        return super().__hash__() + hash(self.t)
+        return (super().__hash__() if self.now is None else hash(self.now)) + hash(self.t)
     
     def to_now(self):
-        return BEvent(self.name, self.data)
+        return BEvent(self.name, self.data) if self.now is None else self.now
+
+    '''event requested t from now, sharing the hash of an interned event'''
+    @staticmethod
+    def of(event, t):
+        return TEvent(t, event.name, dict(event.data), now=event)
 
 TE = TEvent
 
@@ -48,12 +65,318 @@ class Component:
     def __init__(self, name, ctype):
         self.name = name
         self.ctype = ctype
+        self.events = {}  # event name -> interned event
+        self.event_sets = {}  # event names -> interned events
 
     def __repr__(self) -> str:
         return f'({self.ctype.name}) {self.name}'
 
 
+event_ids = itertools.count()
+
+
+class InternedEvent(BEvent):
+    '''Event shared by every statement that names it, one per (name,
+    component) or (name, line), from component_event and line_event. The
+    hash is computed once and every interned event gets an integer id.
+    Two interned events are equal only if they are the same object; against
+    plain BEvents they compare and hash by value, as BEvent does, and
+    against TEvents only when t == 0, as TEvent does. Interned
+    events are immutable (read only data, no attribute updates), copies
+    are the event itself and pickles are plain BEvents.'''
+
+    def __init__(self, name, data):
+        super().__init__(name, MappingProxyType(dict(data)))
+        self.id = next(event_ids)
+        self.hash_value = hash((name, frozenset(self.data.items())))
+        self.frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, 'frozen', False):
+            raise AttributeError('interned events are immutable')
+        super().__setattr__(name, value)
+
+    def __hash__(self):
+        return self.hash_value
+
+    def __eq__(self, other):
+        if other is self:
+            return True
+        if type(other) is InternedEvent:
+            return False
+        if isinstance(other, TEvent):  # TEvent decides, equal only if t == 0
+            return NotImplemented
+        return super().__eq__(other)
+
+    def __repr__(self):
+        return f'BEvent(name={self.name},data={dict(self.data)})'
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return BEvent, (self.name, dict(self.data))
+
+
+line_events = {}  # (line name, event name) -> interned event
+
+'''interned event name of component c'''
+def component_event(c, name):
+    e = c.events.get(name)
+    if e is None:
+        e = c.events[name] = InternedEvent(name, {'c': c})
+    return e
+
+'''interned event name of line l'''
+def line_event(l, name):
+    e = line_events.get((l, name))
+    if e is None:
+        e = line_events[l, name] = InternedEvent(name, {'l': l})
+    return e
+
+'''interned tuple of the events of component c with the given names, for
+request, waitFor and block fields that stay the same on every loop'''
+def component_events(c, names):
+    names = tuple(names)
+    events = c.event_sets.get(names)
+    if events is None:
+        events = c.event_sets[names] = tuple(component_event(c, n) for n in names)
+    return events
+
+
+class GridState:
+    '''Component and line status backed by a single numpy buffer.
+    Components and lines get integer ids; per-line counts of ON and BROKEN
+    components are kept up to date on every component update, so line
+    queries are O(1) and a snapshot is one array copy. observer, when set,
+    is told of every status change (see occupancy.Occupancy).'''
+
+    def __init__(self, comps, l_names, lines):
+        self.comps = list(comps)
+        self.l_names = list(l_names)
+        self.cid = {c: i for i, c in enumerate(self.comps)}
+        self.lid = {l: i for i, l in enumerate(self.l_names)}
+        n_c, n_l = len(self.comps), len(self.l_names)
+        self.incidence = np.zeros((n_l, n_c), dtype=bool)  # line x component
+        for l, line_comps in enumerate(lines):
+            self.incidence[l, [self.cid[c] for c in line_comps]] = True
+        self.comp_lines = [np.flatnonzero(col).tolist() for col in self.incidence.T]
+        self.by_value = {s.value: s for s in Status}
+        self.line_size = self.incidence.sum(axis=1)
+        # [component status | line status | ON count | BROKEN count]
+        self.buffer = np.zeros(n_c + 3 * n_l, dtype=np.int64)
+        self.c_status = self.buffer[:n_c]
+        self.l_status = self.buffer[n_c:n_c + n_l]
+        self.n_on = self.buffer[n_c + n_l:n_c + 2 * n_l]
+        self.n_broken = self.buffer[n_c + 2 * n_l:]
+        self.c_status[:] = Status.OFF.value
+        self.l_status[:] = Status.OFF.value
+        self.observer = None
+
+    def component(self, c):
+        return self.by_value[int(self.c_status[self.cid[c]])]
+
+    def line(self, l):
+        return self.by_value[int(self.l_status[self.lid[l]])]
+
+    def set_component(self, c, status):
+        i = self.cid[c]
+        old = int(self.c_status[i])
+        if old == status.value:
+            return False
+        on, broken = Status.ON.value, Status.BROKEN.value
+        for l in self.comp_lines[i]:
+            self.n_on[l] += (status.value == on) - (old == on)
+            self.n_broken[l] += (status.value == broken) - (old == broken)
+        self.c_status[i] = status.value
+        if self.observer is not None:
+            self.observer.component_changed(i, old, status.value)
+        return True
+
+    def set_line(self, l, status):
+        i = self.lid[l]
+        old = int(self.l_status[i])
+        if old == status.value:
+            return False
+        self.l_status[i] = status.value
+        if self.observer is not None:
+            self.observer.line_changed(i, old, status.value)
+        return True
+
+    def line_has_broken(self, l):
+        return self.n_broken[self.lid[l]] > 0
+
+    def line_all_on(self, l):
+        i = self.lid[l]
+        return self.n_on[i] == self.line_size[i]
+
+    def any_line(self, status):
+        return bool((self.l_status == status.value).any())
+
+    def snapshot(self):
+        return self.buffer.copy()
+
+    def restore(self, snapshot):
+        self.buffer[:] = snapshot
+
+
+'''lookup key of an event, (name, component, line)'''
+def event_key(e):
+    return e.name, e.data.get('c'), e.data.get('l')
+
+'''all index patterns an event key can be registered under (None = any)'''
+def key_patterns(key):
+    n, c, l = key
+    return [(n, c, l), (n, c, None), (n, None, l), (n, None, None),
+            (None, c, l), (None, c, None), (None, None, l), (None, None, None)]
+
+
+class KeyedEventSet(EventSet):
+    '''Event set defined by (name, component, line) patterns instead of an
+    opaque predicate, so programs can index waiting bthreads by key'''
+
+    def __init__(self, patterns):
+        self.patterns = frozenset(patterns)
+        super().__init__(self.__contains__)
+
+    def __contains__(self, e):
+        if not isinstance(e, BEvent):
+            return False
+        return any(p in self.patterns for p in key_patterns(event_key(e)))
+
+    def __eq__(self, other):
+        return isinstance(other, KeyedEventSet) and self.patterns == other.patterns
+
+    def __hash__(self):
+        return hash(self.patterns)
+
+    def __repr__(self):
+        return f'KeyedEventSet({sorted(self.patterns, key=str)})'
+
+    __str__ = __repr__
+
+
+'''events with any of the given names, components and lines (None = any)'''
+def keyed_set(names=None, cs=None, ls=None):
+    return KeyedEventSet(itertools.product(
+        names if names is not None else [None],
+        cs if cs is not None else [None],
+        ls if ls is not None else [None]))
+
+
+'''index patterns of a request/waitFor field, None if it cannot be indexed'''
+def statement_patterns(field):
+    if field is None:
+        return []
+    if isinstance(field, BEvent):
+        return [event_key(field)]
+    if isinstance(field, KeyedEventSet):
+        return list(field.patterns)
+    if isinstance(field, EventSet):
+        return None
+    patterns = []
+    for item in field:
+        item_patterns = statement_patterns(item)
+        if item_patterns is None:
+            return None
+        patterns.extend(item_patterns)
+    return patterns
+
+
+class RandomStream:
+    '''Hands out variates one at a time from blocks drawn with a seeded
+    numpy Generator, avoiding a scipy rvs call per event. The generator is
+    only built on the first draw and blocks start at first variates,
+    doubling up to block, so streams that draw little (most of them in a
+    replication) cost little; drawing in blocks of any size gives the same
+    numbers. The generator state before each block is kept, so the stream
+    state can be saved without the blocks'''
+
+    def __init__(self, seed=None, block=1024, first=16):
+        self.seed = seed
+        self.rng = None
+        self.block = block
+        self.first = first
+        self.exp_buf, self.exp_i, self.exp_state = [], 0, None
+        self.uni_buf, self.uni_i, self.uni_state = [], 0, None
+
+    def generator(self):
+        if self.rng is None:
+            self.rng = np.random.default_rng(self.seed)
+        return self.rng
+
+    # size of the block after one of n variates
+    def next_size(self, n):
+        return min(max(2 * n, self.first), self.block)
+
+    def exponential(self, scale):
+        if self.exp_i == len(self.exp_buf):
+            rng = self.generator()
+            self.exp_state = rng.bit_generator.state
+            self.exp_buf, self.exp_i = rng.standard_exponential(self.next_size(len(self.exp_buf))).tolist(), 0
+        x = self.exp_buf[self.exp_i]
+        self.exp_i += 1
+        return x * scale
+
+    def uniform(self):
+        if self.uni_i == len(self.uni_buf):
+            rng = self.generator()
+            self.uni_state = rng.bit_generator.state
+            self.uni_buf, self.uni_i = rng.random(self.next_size(len(self.uni_buf))).tolist(), 0
+        x = self.uni_buf[self.uni_i]
+        self.uni_i += 1
+        return x
+
+    def bernoulli(self, p):
+        return self.uniform() <= p
+
+    def get_state(self):
+        return {'rng': self.generator().bit_generator.state,
+                'exp': (self.exp_state, self.exp_i, len(self.exp_buf)),
+                'uni': (self.uni_state, self.uni_i, len(self.uni_buf))}
+
+    def set_state(self, state):
+        rng = self.generator()
+        bit_generator = rng.bit_generator
+        exp_state, self.exp_i, n = state['exp']
+        self.exp_state, self.exp_buf = exp_state, []
+        if exp_state is not None:
+            bit_generator.state = exp_state
+            self.exp_buf = rng.standard_exponential(n).tolist()
+        uni_state, self.uni_i, n = state['uni']
+        self.uni_state, self.uni_buf = uni_state, []
+        if uni_state is not None:
+            bit_generator.state = uni_state
+            self.uni_buf = rng.random(n).tolist()
+        bit_generator.state = state['rng']
+
+
+'''one independent stream per key, spawned from a single seed'''
+def spawn_streams(keys, seed=None, block=1024):
+    keys = list(keys)
+    children = np.random.SeedSequence(seed).spawn(len(keys))
+    return {k: RandomStream(s, block) for k, s in zip(keys, children)}
+
+
+stream_kinds = ['decay', 'repair', 'toggle']
+
+'''one stream per (component name, kind), seeded from (seed, name, kind)
+rather than from the position of the component, so model variants run on
+the same seed draw the same numbers for the components they have in common
+(common random numbers)'''
+def component_streams(names, seed=None, block=1024):
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    # the seed sequence is made from the entropy list on the first draw
+    return {(name, kind): RandomStream([seed, int.from_bytes(f'{name}/{kind}'.encode(), 'little')], block)
+            for name in names for kind in stream_kinds}
+
+
 class AlarmEventSelection(bp.SimpleEventSelectionStrategy):
+    rewrites_statements = True  # is_satisfied must see every statement
 
     def __init__(self, max_time, time_eps=1e-5) -> None:
         super().__init__()
@@ -68,12 +391,10 @@ class AlarmEventSelection(bp.SimpleEventSelectionStrategy):
         # reduces time passed from statement timed requests
         t_passed = event.t
         if 'request' in statement: 
-            if isinstance(statement['request'], Iterable):
-                requests = statement['request']
-            elif isinstance(statement['request'], BEvent):
-                requests = [statement['request']]
-            new_events = [self.advance_time(e, t_passed) for e in requests]
-            statement['request'] = new_events
+            if isinstance(statement['request'], BEvent):
+                statement['request'] = self.advance_time(statement['request'], t_passed)
+            elif isinstance(statement['request'], Iterable):
+                statement['request'] = [self.advance_time(e, t_passed) for e in statement['request']]
         # normal selected event sat conditions after time passing
         return super().is_satisfied(self.advance_time(event, t_passed), statement)
 
@@ -121,21 +442,709 @@ class AlarmEventSelection(bp.SimpleEventSelectionStrategy):
         self.elapsed += event.t
         return event
 
+    # request field of a statement with timed requests relative to now
+    def remaining(self, statement):
+        return statement.get('request')
+
+
+class HeapAlarmEventSelection(AlarmEventSelection):
+    '''Same semantics as AlarmEventSelection, but timed requests are kept
+    as absolute deadlines (elapsed + t) in a heap instead of being rewritten
+    on every step. Statements are registered once, when first seen, and
+    dropped when their bthread advances; statements are never mutated.
+    The ticket list of the program is tracked between steps: tickets are
+    updated in place, so only the statements of bthreads that advanced
+    (found satisfied by is_satisfied) and of newly loaded tickets are
+    registered again, and a step costs in the number of woken bthreads
+    rather than in the number of bthreads.'''
+    rewrites_statements = False
+
+    def __init__(self, max_time, time_eps=1e-5) -> None:
+        super().__init__(max_time, time_eps)
+        self.deadlines = []  # heap of (deadline, seq, statement id, record, event)
+        # statement id -> (request object, now requests, [(deadline, event)], block patterns)
+        self.registered = {}
+        self.blocks = {}  # key pattern -> {statement id: block field}
+        self.opaque_blocks = {}  # statement id -> unindexable block field
+        self.seq = itertools.count()
+        self.tracked = None  # ticket list registered incrementally
+        self.statements = {}  # statement id -> tracked statement
+        self.positions = {}  # statement id -> ticket position
+        self.now_requests = {}  # statement id -> its untimed requests, if any
+        self.stale = set()  # statement ids of bthreads that advanced
+
+    def register(self, statement):
+        sid = id(statement)
+        request = statement.get('request')
+        record = self.registered.get(sid)
+        if record is not None:
+            if record[0] is request:
+                return record
+            self.deregister(sid)
+        if request is None:
+            requests = []
+        elif isinstance(request, BEvent):
+            requests = [request]
+        elif isinstance(request, Iterable):
+            requests = request
+        else:
+            raise TypeError("request parameter should be BEvent or iterable")
+        now = [e for e in requests if not isinstance(e, TEvent)]
+        timed = [(self.elapsed + e.t, e) for e in requests if isinstance(e, TEvent)]
+        block = statement.get('block')
+        patterns = statement_patterns(block) if block is not None else []
+        if patterns is None:
+            self.opaque_blocks[sid] = block
+        for p in patterns or ():
+            self.blocks.setdefault(p, {})[sid] = block
+        record = (request, now, timed, patterns)
+        self.registered[sid] = record
+        self.push(sid, record, statement)
+        return record
+
+    def push(self, sid, record, statement):
+        for deadline, e in record[2]:
+            heapq.heappush(self.deadlines, (deadline, next(self.seq), sid, record, e))
+
+    def remaining(self, statement):
+        request = statement.get('request')
+        record = self.registered.get(id(statement))
+        if request is None or record is None or record[0] is not request:
+            return request  # not registered yet, times are relative to now
+        deadlines = iter(record[2])
+
+        def left(e):
+            if not isinstance(e, TEvent):
+                return e
+            deadline, _ = next(deadlines)
+            e = copy(e)
+            e.t = max(deadline - self.elapsed, 0.0)
+            return e
+        if isinstance(request, BEvent):
+            return left(request)
+        return [left(e) for e in request]
+
+    def deregister(self, sid):
+        record = self.registered.pop(sid, None)
+        if record is None:
+            return
+        self.opaque_blocks.pop(sid, None)
+        for p in record[3] or ():
+            self.blocks[p].pop(sid, None)
+
+    def is_satisfied(self, event, statement):
+        if not isinstance(event, TEvent):
+            now_event = event
+        else:
+            now_event = event.to_now()
+        block = statement.get('block')
+        if isinstance(block, BEvent):
+            if block == now_event:
+                return False
+        elif block is not None and now_event in block:
+            return False
+        record = self.registered.get(id(statement))
+        request = statement.get('request')
+        satisfied = False
+        if isinstance(request, BEvent) and not isinstance(request, TEvent):
+            satisfied = request == now_event
+        elif request is not None:
+            due = self.elapsed + self.time_eps
+            timed = record[2] if record is not None and record[0] is request else []
+            if any(e.to_now() == now_event and deadline <= due for deadline, e in timed):
+                satisfied = True
+            elif not isinstance(request, BEvent):
+                satisfied = any(e == now_event for e in request
+                                if not isinstance(e, TEvent))
+        if not satisfied:
+            wait = statement.get('waitFor')
+            if isinstance(wait, BEvent):
+                satisfied = wait == now_event
+            elif wait is not None:
+                satisfied = now_event in wait
+        if satisfied:  # bthread yields a new statement, re-registered lazily
+            self.deregister(id(statement))
+            self.stale.add(id(statement))
+        return satisfied
+
+    def is_blocked(self, event):
+        for p in key_patterns(event_key(event)):
+            for block in self.blocks.get(p, {}).values():
+                if isinstance(block, BEvent):
+                    if block == event:
+                        return True
+                elif event in block:
+                    return True
+        for block in self.opaque_blocks.values():
+            if event in block:
+                return True
+        return False
+
+    # a tracked ticket was changed in place (bthread loaded into a reused slot,
+    # removed, suspended or resumed), registered again on the next step
+    def statement_changed(self, statement):
+        self.deregister(id(statement))
+        self.stale.add(id(statement))
+
+    def refresh(self, sid):
+        now = self.register(self.statements[sid])[1]
+        if now:
+            self.now_requests[sid] = now
+        else:
+            self.now_requests.pop(sid, None)
+
+    def add_statement(self, i, statement):
+        sid = id(statement)
+        self.statements[sid] = statement
+        self.positions[sid] = i
+        self.refresh(sid)
+
+    # brings the registrations up to date with statements
+    def track(self, statements):
+        if statements is not self.tracked:  # full scan of a list not seen before
+            self.tracked = statements
+            self.statements, self.positions, self.now_requests = {}, {}, {}
+            self.stale = set()
+            for i, statement in enumerate(statements):
+                self.add_statement(i, statement)
+            for sid in [sid for sid in self.registered if sid not in self.statements]:
+                self.deregister(sid)
+            return
+        for i in range(len(self.positions), len(statements)):  # loaded bthreads
+            self.add_statement(i, statements[i])
+        # in ticket order, so registrations (and their sequence numbers) are reproducible
+        for sid in sorted((sid for sid in self.stale if sid in self.statements),
+                          key=self.positions.__getitem__):
+            self.refresh(sid)
+        self.stale.clear()
+
+    def selectable_events(self, statements):
+        self.track(statements)
+        now_events = {}  # in ticket order, keeps selection independent of hash seeds
+        for sid in sorted(self.now_requests, key=self.positions.__getitem__):
+            now_events.update(dict.fromkeys(self.now_requests[sid]))
+        now_events = [e for e in now_events if not self.is_blocked(e)]
+
+        # earliest unblocked deadlines, blocked ones are put back afterwards
+        next_t = 0 if now_events else None
+        timed_events = {}
+        skipped = []
+        while self.deadlines:
+            entry = self.deadlines[0]
+            deadline, _, sid, record, e = entry
+            if self.registered.get(sid) is not record:  # stale
+                heapq.heappop(self.deadlines)
+                continue
+            t = max(deadline - self.elapsed, 0)
+            if next_t is not None and t - next_t >= self.time_eps:
+                break
+            heapq.heappop(self.deadlines)
+            skipped.append(entry)
+            if self.is_blocked(e.to_now()):
+                continue
+            if next_t is None:
+                next_t = t
+            if t <= self.time_eps:
+                e = e.to_now()
+            else:
+                e = copy(e)
+                e.t = t
+            timed_events.setdefault(e, t)
+        for entry in skipped:
+            heapq.heappush(self.deadlines, entry)
+
+        if next_t is None:
+            return set()
+        if self.elapsed + next_t > self.max_time:  # block events if max_time is surpassed
+            return set()
+        return now_events + [e for e in timed_events if not isinstance(e, TEvent)
+                             or e not in now_events]
+
+
+
+class PriorityAlarmEventSelection(HeapAlarmEventSelection):
+    '''HeapAlarmEventSelection with the statement priorities of
+    bp.PriorityBasedEventSelectionStrategy (priority=, higher first,
+    default_priority when missing) and no random choice: events are ordered
+    by (deadline, priority, registration sequence), so simultaneous events
+    (a d_fail and the req_repair it triggers) come in a reproducible order.
+    Untimed requests, and timed ones once due, are kept in a heap by
+    (priority, sequence); pending deadlines in a heap by (deadline,
+    priority, sequence). Entries are dropped lazily when their statement is
+    no longer registered, and blocked entries are put back, so a step costs
+    O(log n) plus the blocked entries on top. selectable_events returns the
+    highest priority events of the next instant in sequence order; select
+    takes the first.'''
+
+    def __init__(self, max_time, time_eps=1e-5, default_priority=5) -> None:
+        super().__init__(max_time, time_eps)
+        self.default_priority = default_priority
+        self.due = []  # heap of (-priority, seq, statement id, record, event)
+
+    def push(self, sid, record, statement):
+        p = -statement.get('priority', self.default_priority)
+        for e in record[1]:
+            heapq.heappush(self.due, (p, next(self.seq), sid, record, e))
+        for deadline, e in record[2]:
+            heapq.heappush(self.deadlines, (deadline, p, next(self.seq), sid, record, e))
+
+    # unblocked entries of the first group (same(first, entry)) on top of heap,
+    # best priority first; stale entries are dropped, the others put back
+    def top(self, heap, same):
+        first, group, skipped = None, [], []
+        while heap:
+            entry = heap[0]
+            if self.registered.get(entry[-3]) is not entry[-2]:  # stale
+                heapq.heappop(heap)
+                continue
+            if first is not None and not same(first, entry):
+                break
+            skipped.append(heapq.heappop(heap))
+            e = entry[-1]
+            if self.is_blocked(e.to_now() if isinstance(e, TEvent) else e):
+                continue
+            first = first or entry
+            group.append(entry)
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        best = min((entry[-5] for entry in group), default=None)
+        return [entry for entry in sorted(group, key=lambda entry: entry[-4]) if entry[-5] == best]
+
+    def selectable_events(self, statements):
+        self.track(statements)
+        due = self.elapsed + self.time_eps
+        while self.deadlines and self.deadlines[0][0] <= due:  # reached deadlines are untimed now
+            deadline, p, seq, sid, record, e = heapq.heappop(self.deadlines)
+            if self.registered.get(sid) is record:
+                heapq.heappush(self.due, (p, seq, sid, record, e.to_now()))
+        group = self.top(self.due, lambda first, entry: entry[0] == first[0])
+        if group:
+            return list(dict.fromkeys(entry[-1] for entry in group))
+        group = self.top(self.deadlines, lambda first, entry: entry[0] - first[0] < self.time_eps)
+        if not group:
+            return []
+        t = max(min(entry[0] for entry in group) - self.elapsed, 0)
+        if self.elapsed + t > self.max_time:  # block events if max_time is surpassed
+            return []
+        events = []
+        for entry in group:
+            e = copy(entry[-1])
+            e.t = t
+            events.append(e)
+        return list(dict.fromkeys(events))
+
+    def select(self, statements, external_events_queue=[]):
+        events = self.selectable_events(statements)
+        if not events:
+            return external_events_queue.pop(0) if external_events_queue else None
+        event = events[0]
+        if isinstance(event, TEvent):
+            self.elapsed += event.t
+        return event
+
+'''events as plain tuples, components replaced by their GridState ids'''
+def pack_event(e, context):
+    data = tuple((k, (True, context.cid[v]) if isinstance(v, Component) else (False, v))
+                 for k, v in e.data.items())
+    return e.name, data, e.t if isinstance(e, TEvent) else None
+
+# component and line events come back as their interned events
+def unpack_event(packed, context):
+    name, data, t = packed
+    data = {k: context.comps[v] if is_c else v for k, (is_c, v) in data}
+    if len(data) == 1 and isinstance(data.get('c'), Component):
+        e = component_event(data['c'], name)
+    elif len(data) == 1 and isinstance(data.get('l'), str):
+        e = line_event(data['l'], name)
+    else:
+        return BEvent(name, data) if t is None else TEvent(t, name, data)
+    return e if t is None else TEvent.of(e, t)
+
+def pack_request(request, context):
+    if request is None:
+        return None
+    if isinstance(request, BEvent):
+        return True, [pack_event(request, context)]
+    return False, [pack_event(e, context) for e in request]
+
+def unpack_request(packed, context):
+    if packed is None:
+        return None
+    single, events = packed
+    events = [unpack_event(e, context) for e in events]
+    return events[0] if single else events
+
+
+'''generator frame behind a bthread, the function wrapped by bp.thread
+when there is one'''
+def bthread_frame(bt):
+    frame = bt.gi_frame
+    inner = frame.f_locals.get('f') if frame is not None else None
+    if inspect.isgenerator(inner) and inner.gi_frame is not None:
+        return inner.gi_frame
+    return frame
+
+'''(code position, locals) of a bthread at its statement, None when it is
+done; mutable locals are copied, so changes made to them later are not
+taken for a return to the same head'''
+def bthread_head(ticket):
+    frame = bthread_frame(ticket['bt']) if ticket else None
+    if frame is None:
+        return None
+    return frame.f_lasti, {k: copy(v) if isinstance(v, (list, dict, set)) else v
+                           for k, v in frame.f_locals.items()}
+
+def same_value(a, b):
+    try:
+        return a is b or (type(a) is type(b) and bool(a == b))
+    except (TypeError, ValueError):
+        return False
+
+
+'''compact serialized form of ContextualBProgram.checkpoint()'''
+def dump_checkpoint(snapshot):
+    return zlib.compress(pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL))
+
+def load_checkpoint(data):
+    return pickle.loads(zlib.decompress(data))
+
 
 class ContextualBProgram(bp.BProgram):
+    '''BProgram with a shared context updated by effect on every selected
+    event. indexed=True dispatches selected events only to the bthreads
+    requesting or waiting for them. checkpoints=True keeps, per bthread,
+    the events received since it last passed its loop head (same code
+    position and initial locals), so the run can be checkpointed and
+    restored into a fresh program; streams are the random streams of the
+    bthreads, saved with the checkpoint.
+    Every loaded bthread has a handle. add_bthread, remove_bthread,
+    suspend_bthread and resume_bthread work by handle in constant time
+    (plus the index update of one statement), also from inside running
+    bthreads: tickets keep their position, the slots of finished and
+    removed bthreads are reused (except with checkpoints, which only cover
+    the factory bthreads), and the strategy is told which ticket changed.'''
+
     def __init__(self, context, effect,
                  bthreads=None,
                  source_name=None,
                  event_selection_strategy=None,
-                 listener=None):
+                 listener=None,
+                 indexed=False,
+                 streams=None,
+                 checkpoints=False):
         super().__init__(bthreads, source_name, event_selection_strategy, listener)
         self.context = context
         self.effect = effect
-        
+        # dispatch index: key pattern -> positions of tickets requesting or waiting on it
+        self.indexed = indexed
+        self.index = {}
+        self.ticket_patterns = []
+        self.unindexed = set()  # tickets with opaque event sets, always checked
+        self.streams = streams or {}
+        # replay logs: ticket position -> ids of events received since its loop head
+        self.histories = [] if checkpoints else None
+        self.heads = []  # ticket position -> (code position, locals) of its first statement
+        self.event_ids = {}
+        self.event_table = []
+        # handles: handle -> ticket position, position -> handle, reusable positions
+        self.handles = {}
+        self.slot_handles = []
+        self.free = []
+        self.next_handle = 0
+        self.pending = {}  # id of an added bthread not loaded yet -> its handle
+        self.queued = set()  # handles of added bthreads not loaded yet
+        self.cancelled = set()  # queued handles removed before loading
+        self.suspended = {}  # handle -> statement set aside
+        self.dynamic = False  # bthreads were added, removed or suspended
+        self.loaded = False
+        self.started = False
+
+    def use_index(self):
+        return self.indexed and not getattr(self.event_selection_strategy, 'rewrites_statements', False)
+
+    def reindex(self, i):
+        for p in self.ticket_patterns[i]:
+            self.index[p].discard(i)
+        self.unindexed.discard(i)
+        statement = self.tickets[i]
+        patterns = []
+        for field in ('request', 'waitFor'):
+            field_patterns = statement_patterns(statement.get(field))
+            if field_patterns is None:
+                self.unindexed.add(i)
+                patterns = []
+                break
+            patterns.extend(field_patterns)
+        self.ticket_patterns[i] = patterns
+        for p in patterns:
+            self.index.setdefault(p, set()).add(i)
+
+    def setup(self):
+        if not self.loaded:  # paused and restored programs keep their bthreads
+            if self.new_bt:  # added before setup, loaded after the initial ones
+                self.bthreads = list(self.bthreads or []) + self.new_bt
+                self.new_bt = []
+            super().setup()
+            self.loaded = True
+
+    def load_new_bthreads(self):
+        while self.new_bt:
+            bts = list(self.new_bt)
+            self.new_bt.clear()
+            for bt in bts:
+                handle = self.pending.pop(id(bt), None)
+                if handle is None:
+                    handle = self.next_handle
+                    self.next_handle += 1
+                else:
+                    self.queued.discard(handle)
+                    if handle in self.cancelled:
+                        self.cancelled.discard(handle)
+                        bt.close()
+                        continue
+                self.load(bt, handle)
+
+    # runs bt to its first statement in a free slot, or in a new one
+    def load(self, bt, handle):
+        reused = bool(self.free)
+        if reused:
+            i = self.free.pop()
+            ticket = self.tickets[i]
+            ticket['bt'] = bt
+        else:
+            i = len(self.tickets)
+            ticket = {'bt': bt}
+            self.tickets.append(ticket)
+            self.slot_handles.append(None)
+        self.handles[handle] = i
+        self.slot_handles[i] = handle
+        self.send(ticket, None)
+        if self.histories is not None:
+            head = bthread_head(ticket)
+            if reused:
+                self.heads[i], self.histories[i] = head, []
+            else:
+                self.heads.append(head)
+                self.histories.append([])
+        if self.use_index():
+            if not reused:
+                self.ticket_patterns.append([])
+            self.reindex(i)
+        if reused:
+            self.changed(i)
+        if not ticket:  # done without a statement
+            self.release(i)
+
+    # frees the slot of a finished or removed bthread
+    def release(self, i):
+        handle = self.slot_handles[i]
+        if handle is None:
+            return
+        self.slot_handles[i] = None
+        del self.handles[handle]
+        if self.histories is None:
+            self.free.append(i)
+
+    # ticket i was changed outside of advance_bthreads
+    def changed(self, i):
+        if self.use_index():
+            self.reindex(i)
+        statement_changed = getattr(self.event_selection_strategy, 'statement_changed', None)
+        if statement_changed is not None:
+            statement_changed(self.tickets[i])
+
+    '''queues bt, loaded (run to its first statement) before the next
+    selection, and returns its handle'''
+    def add_bthread(self, bt):
+        handle = self.next_handle
+        self.next_handle += 1
+        self.pending[id(bt)] = handle
+        self.queued.add(handle)
+        self.new_bt.append(bt)
+        self.dynamic = True
+        return handle
+
+    '''removes a bthread with its requests, waits and blocks and closes its
+    generator; a bthread may remove itself'''
+    def remove_bthread(self, handle):
+        self.dynamic = True
+        if handle in self.queued:
+            self.queued.discard(handle)
+            self.cancelled.add(handle)
+            return
+        i = self.handles[handle]
+        statement = self.suspended.pop(handle, None)
+        if statement is None:
+            statement = dict(self.tickets[i])
+            self.tickets[i].clear()
+            self.changed(i)
+        self.release(i)
+        bt = statement.get('bt')
+        if bt is not None:
+            bt.close()
+
+    '''sets a bthread aside until resume_bthread: its requests, waits and
+    blocks do not take part in selection, and its timed requests resume
+    with the time they had left'''
+    def suspend_bthread(self, handle):
+        i = self.handles[handle]
+        ticket = self.tickets[i]
+        if handle in self.suspended:
+            return
+        if not ticket:
+            raise ValueError('only a bthread waiting at a statement can be suspended')
+        statement = dict(ticket)
+        if 'request' in statement and hasattr(self.event_selection_strategy, 'remaining'):
+            statement['request'] = self.event_selection_strategy.remaining(ticket)
+        self.suspended[handle] = statement
+        ticket.clear()
+        self.changed(i)
+        self.dynamic = True
+
+    def resume_bthread(self, handle):
+        statement = self.suspended.pop(handle)
+        i = self.handles[handle]
+        self.tickets[i].update(statement)
+        self.changed(i)
+
+    @staticmethod
+    def send(ticket, m):
+        try:
+            bt = ticket['bt']
+            ticket.clear()
+            ll = bt.send(m)
+            if ll is not None:
+                ticket.update(ll)
+                ticket.update({'bt': bt})
+        except (KeyError, StopIteration):
+            pass
+
+    # logs m for ticket i, or drops the log when the bthread is back at its head
+    def record(self, i, m):
+        ticket, head = self.tickets[i], self.heads[i]
+        if ticket and head is not None:
+            frame = bthread_frame(ticket['bt'])
+            lasti, head_locals = head
+            if frame.f_lasti == lasti and all(
+                    k in frame.f_locals and same_value(frame.f_locals[k], v)
+                    for k, v in head_locals.items()):
+                self.histories[i].clear()
+                return
+        if isinstance(m, TEvent):
+            m = m.to_now()
+        eid = self.event_ids.get(m)
+        if eid is None:
+            eid = self.event_ids[m] = len(self.event_table)
+            self.event_table.append(m)
+        self.histories[i].append(eid)
+
+    def advance_bthreads(self, tickets, m):
+        if m is None or tickets is not self.tickets:
+            return super().advance_bthreads(tickets, m)
+        indexed = self.use_index()
+        if indexed:
+            candidates = set(self.unindexed)
+            for p in key_patterns(event_key(m)):
+                candidates.update(self.index.get(p, ()))
+            positions = sorted(candidates)  # same order as a full scan
+        else:
+            positions = range(len(tickets))
+        for i in positions:
+            l = tickets[i]
+            if self.event_selection_strategy.is_satisfied(m, l):
+                self.send(l, m)
+                if self.slot_handles[i] is None:  # removed itself
+                    l.clear()
+                elif not l:  # done
+                    self.release(i)
+                if self.histories is not None:
+                    self.record(i, m)
+                if indexed:
+                    self.reindex(i)
+
     def next_event(self):
         e = super().next_event()
         if e: # dont wan't to throw exceptions at the end
             if self.effect(self.context, e): # if context changed
                 #queries()
                 pass
-        return e
\ No newline at end of file
+        return e
+
+    '''runs the program; with until, pauses after the first event at or
+    past that time, with bthreads advanced. run() again continues a paused
+    program. returns whether the run ended'''
+    def run(self, until=None):
+        if self.listener and not self.started:
+            self.listener.starting(b_program=self)
+        self.started = True
+        self.setup()
+        interrupted = False
+        while not interrupted:
+            self.load_new_bthreads()
+            event = self.next_event()
+            if event is None:
+                break
+            if self.listener:
+                interrupted = self.listener.event_selected(b_program=self, event=event)
+            self.advance_bthreads(self.tickets, event)
+            if until is not None and self.event_selection_strategy.elapsed >= until:
+                return False
+        if self.listener:
+            self.listener.ended(b_program=self)
+        return True
+
+    '''picklable state of the run: context, strategy clock, pending
+    requests with their remaining times, bthread replay logs, stream states
+    and the tie-breaking random state. needs checkpoints=True'''
+    def checkpoint(self):
+        if self.histories is None:
+            raise ValueError('program was built without checkpoints=True')
+        if self.dynamic:
+            raise ValueError('bthreads were added, removed or suspended, checkpoints only cover the factory bthreads')
+        strategy, context = self.event_selection_strategy, self.context
+        return {
+            'elapsed': strategy.elapsed,
+            'context': context.snapshot(),
+            'events': [pack_event(e, context) for e in self.event_table],
+            'histories': [np.array(h, dtype=np.int32) for h in self.histories],
+            'requests': [pack_request(strategy.remaining(t), context) if t else None
+                         for t in self.tickets],
+            'streams': [s.get_state() for s in self.streams.values()],
+            'random': random.getstate(),
+        }
+
+    '''rebuilds a checkpointed run in this program, which must be built by
+    the same factory and not run yet. bthreads are replayed from their loop
+    heads against the restored context, so their control flow may depend
+    only on received events and the context; requests (and their drawn
+    times) are taken from the checkpoint. keep_streams keeps this program's
+    own streams and random state, e.g. for replications warm started from a
+    common snapshot'''
+    def restore(self, snapshot, keep_streams=False):
+        if self.loaded:
+            raise ValueError('restore needs a program that has not been run')
+        if self.histories is None:
+            self.histories = []
+        context = self.context
+        context.restore(snapshot['context'])
+        self.setup()
+        if len(snapshot['histories']) != len(self.tickets):
+            raise ValueError('checkpoint does not match the program bthreads')
+        self.event_table = [unpack_event(p, context) for p in snapshot['events']]
+        self.event_ids = {e: i for i, e in enumerate(self.event_table)}
+        for i, (history, request) in enumerate(zip(snapshot['histories'], snapshot['requests'])):
+            ticket = self.tickets[i]
+            for eid in history:
+                self.send(ticket, self.event_table[eid])
+            if request is not None:
+                ticket['request'] = unpack_request(request, context)
+            elif not ticket:  # done
+                self.release(i)
+            self.histories[i] = history.tolist()
+            if self.use_index():
+                self.reindex(i)
+        self.event_selection_strategy.elapsed = snapshot['elapsed']
+        if not keep_streams:
+            for stream, state in zip(self.streams.values(), snapshot['streams']):
+                stream.set_state(state)
+            random.setstate(snapshot['random'])